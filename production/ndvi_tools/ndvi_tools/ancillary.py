@@ -0,0 +1,109 @@
+"""
+Loading of the ancillary products used by the plugins.
+
+``ndvi_climatology_ls`` and ``wofs_ls_summary_alltime`` don't fit the
+odc-stats save-tasks paradigm so they are loaded directly from the
+datacube. ``prefetch`` starts their loads in a background thread from
+``input_data``, while the imagery is loaded. In-memory tiles read them
+there and then. Tiles reduced with Dask only run the datacube lookups, so
+index errors come up before the graph is computed, and their reads join
+the graph and overlap with the imagery's.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import datacube
+import xarray as xr
+from datacube.utils.geometry import GeoBox
+
+MONTHS = (
+    "jan",
+    "feb",
+    "mar",
+    "apr",
+    "may",
+    "jun",
+    "jul",
+    "aug",
+    "sep",
+    "oct",
+    "nov",
+    "dec",
+)
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ndvi-ancillary")
+
+
+def load_wofs_mask(
+    geobox: GeoBox,
+    wofs_threshold: float,
+    dask_chunks: Optional[Dict[str, Any]] = None,
+) -> xr.DataArray:
+    """
+    True where the all-time WOfS frequency is below ``wofs_threshold``,
+    i.e. not a permanent waterbody.
+    """
+    dc = datacube.Datacube(app="Vegetation_anomalies")
+    wofs = dc.load(
+        product="wofs_ls_summary_alltime",
+        measurements=["frequency"],
+        like=geobox,
+        dask_chunks=dask_chunks,
+    ).frequency.squeeze()
+
+    # set masked terrain regions to 0
+    wofs = xr.where(wofs.isnull(), 0, wofs)
+
+    # threshold to create waterbodies mask
+    return wofs < wofs_threshold
+
+
+def load_climatology(
+    geobox: GeoBox,
+    month: str,
+    min_num_obs: int,
+    resampling: str = "bilinear",
+    dask_chunks: Optional[Dict[str, Any]] = None,
+) -> xr.Dataset:
+    """
+    Load ``mean_<month>`` and ``stddev_<month>`` from ndvi_climatology_ls,
+    masked where the climatology has fewer than ``min_num_obs`` observations.
+    """
+    dc = datacube.Datacube(app="Vegetation_anomalies")
+    ndvi_clim = (
+        dc.load(
+            product="ndvi_climatology_ls",
+            like=geobox,
+            measurements=["mean_" + month, "stddev_" + month, "count_" + month],
+            dask_chunks=dask_chunks,
+            resampling=resampling,
+        )
+        .squeeze()
+        .drop("time")
+    )  # Remove time dimension
+
+    # --Make a quality assurance mask where clear observation count is low
+    #  in the ndvi-climatology product ----
+    qa_mask = ndvi_clim["count_" + month] >= min_num_obs
+
+    # remove pixels where obs are < min_num_obs
+    return ndvi_clim.where(qa_mask)
+
+
+def prefetch(load, *args, **kwargs) -> Future:
+    """
+    Run ``load(*args, **kwargs)`` in a background thread.
+    """
+    return _executor.submit(load, *args, **kwargs)
+
+
+def fetched(ancillary: Future, like: xr.Dataset):
+    """
+    Wait for a prefetched load and cut it to the ``like`` window. Errors
+    raised by the load surface here.
+    """
+    xx = ancillary.result()
+    if xx.sizes["y"] != like.sizes["y"] or xx.sizes["x"] != like.sizes["x"]:
+        xx = xx.sel(y=like.y, x=like.x)
+
+    return xx
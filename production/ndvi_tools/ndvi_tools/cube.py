@@ -0,0 +1,372 @@
+"""
+Per-tile monthly NDVI cube, a reusable intermediate product.
+
+For every month the cube holds the sum and sum of squares of the smoothed
+NDVI, the clear count, and the last ``rolling_window - 1`` raw observations
+(the tail) so smoothing can continue into the next month. That is all the
+climatology and anomaly reductions need, so once a tile's cube is written
+they can be recomputed without going back to surface reflectance.
+
+The same state makes the current month incremental: newly arrived scenes
+are smoothed from the stored tail and added to the month's sums, so an
+update costs one scene rather than the whole month. The cube records the
+ids of the datasets folded into each updated month, a scene that arrives
+late for a day already folded in makes the update rebuild the month.
+
+Writes are part of the graph the plugins' reduce returns, the cube is
+written when odc-stats computes the outputs, from the same blocks.
+"""
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+import dask
+import fsspec
+import numpy as np
+import xarray as xr
+import zarr
+from datacube.model import Dataset
+from datacube.utils.dates import normalise_dt
+from datacube.utils.geometry import GeoBox
+from odc.algo._grouper import solar_offset
+from odc.dscache.tools.tiling import GRIDS
+
+from .engine import wait_for
+from .precision import decode_ndvi, encode_like
+from .smoothing import smoothed_sums
+
+CUBE_GRID = "africa_30"
+CUBE_MODES = ("write", "read")
+UPDATE_MODE = "update"
+
+
+def tile_index(geobox: GeoBox, grid: str = CUBE_GRID) -> Tuple[int, int]:
+    """
+    ``x`` and ``y`` index of the ``grid`` tile containing ``geobox``.
+    """
+    gs = GRIDS[grid]
+    cx, cy = geobox.extent.centroid.coords[0]
+    x = int((cx - gs.origin[1]) // gs.tile_size[1])
+    y = int((cy - gs.origin[0]) // gs.tile_size[0])
+    return x, y
+
+
+def cube_location(template: str, geobox: GeoBox, grid: str = CUBE_GRID) -> str:
+    """
+    Location of the tile's cube, ``template`` is formatted with the ``x`` and
+    ``y`` tile index, e.g. ``s3://bucket/ndvi_cube/x{x:03d}y{y:03d}.zarr``.
+    """
+    x, y = tile_index(geobox, grid)
+    return template.format(x=x, y=y)
+
+
+def month_range(datasets: Sequence[Dataset]) -> Tuple[np.datetime64, np.datetime64]:
+    """
+    First and last month covered by ``datasets``.
+    """
+    months = [np.datetime64(ds.center_time.strftime("%Y-%m"), "M") for ds in datasets]
+    return min(months), max(months)
+
+
+def monthly_cube(
+    ndvi: xr.DataArray, rolling_window: int, tail: Optional[xr.DataArray] = None
+) -> xr.Dataset:
+    """
+    Build the monthly cube from an NDVI time series, encoded or not.
+
+    Smoothing is the plugins' rolling mean, re-masked to the clear
+    observations. ``tail`` is the previous month's tail; without it the
+    series is smoothed from its first observation, as the plugins do.
+    """
+    ntail = rolling_window - 1
+    months = ndvi.spec["time"].values.astype("datetime64[M]")
+    raw = xr.DataArray(
+        ndvi.data, dims=("obs", "y", "x"), coords=dict(y=ndvi.y, x=ndvi.x)
+    )
+
+    if tail is None:
+        pad = xr.full_like(raw.isel(obs=[0] * ntail), np.nan, dtype=np.float32)
+    else:
+        pad = xr.DataArray(tail.data, dims=raw.dims, coords=raw.coords)
+
+    key = xr.DataArray(months.astype("datetime64[ns]"), dims="obs", name="time")
+    sums = smoothed_sums(raw, rolling_window, key=key, tail=pad, dim="obs")
+    times = xr.DataArray(ndvi.spec["time"].values.astype("datetime64[ns]"), dims="obs")
+    last_obs = times.groupby(key).max()
+
+    # last raw observations up to the end of every month, from the previous
+    # tail while the series is shorter than it
+    pad = encode_like(pad, raw.dtype)
+    tails = []
+    for end in np.flatnonzero(np.r_[months[1:] != months[:-1], True]):
+        start = end + 1 - ntail
+        recent = raw.isel(obs=slice(max(start, 0), end + 1))
+        if start < 0:
+            recent = xr.concat(
+                [pad.isel(obs=slice(ntail + start, None)), recent], "obs"
+            )
+        tails.append(decode_ndvi(recent))
+    ndvi_tail = xr.concat(tails, dim="time").assign_coords(time=sums.time)
+
+    cube = xr.Dataset(
+        dict(
+            ndvi_sum=sums.ndvi_sum,
+            ndvi_sumsq=sums.ndvi_sumsq,
+            clear_count=sums.clear_count,
+            ndvi_tail=ndvi_tail.astype(np.float32),
+            last_obs=last_obs,
+        )
+    )
+    if "spatial_ref" in ndvi.coords:
+        cube = cube.assign_coords(spatial_ref=ndvi.spatial_ref)
+
+    return cube
+
+
+def open_cube(location: str, chunks=None) -> Optional[xr.Dataset]:
+    fs, path = fsspec.core.url_to_fs(location)
+    if not fs.exists(path):
+        return None
+
+    return xr.open_zarr(location, chunks=chunks)
+
+
+def read_cube(
+    location: str,
+    start: np.datetime64,
+    end: np.datetime64,
+    chunks=None,
+) -> xr.Dataset:
+    """
+    Months ``start`` to ``end`` (inclusive) of the cube at ``location``.
+    """
+    cube = open_cube(location, chunks=chunks)
+    if cube is None:
+        raise ValueError(f"No NDVI cube at {location}")
+
+    start, end = (np.datetime64(t, "M").astype("datetime64[ns]") for t in (start, end))
+    cube = cube.sel(time=slice(start, end))
+    if cube.sizes["time"] == 0:
+        raise ValueError(f"NDVI cube at {location} has no data for {start}--{end}")
+
+    return cube
+
+
+def previous_tail(
+    location: str, month: np.datetime64, chunks=None
+) -> Optional[xr.DataArray]:
+    """
+    Tail of the month before ``month`` if the cube has it.
+    """
+    cube = open_cube(location, chunks=chunks)
+    if cube is None:
+        return None
+
+    previous = (np.datetime64(month, "M") - 1).astype("datetime64[ns]")
+    if previous not in cube.time.values:
+        return None
+
+    return cube.ndvi_tail.sel(time=previous, drop=True)
+
+
+def write_cube(cube: xr.Dataset, location: str, chunks=None, compute: bool = True):
+    """
+    Write ``cube`` to ``location``, overwriting months already there and
+    appending new ones, which must come after the last stored month.
+
+    Without ``compute`` only the store's metadata is written, the delayed
+    writes of the data are returned.
+    """
+    cube = cube.chunk(dict(time=1, obs=-1, **(chunks or {})))
+    for var in cube.variables.values():
+        var.encoding = {}
+
+    existing = open_cube(location)
+    if existing is None:
+        write = cube.to_zarr(location, mode="w-", consolidated=True, compute=compute)
+        return [] if compute else [write]
+
+    # appending rewrites the group's attributes, keep the update records
+    cube = cube.assign_attrs(existing.attrs)
+    stored = existing.time.values
+    overlap = np.isin(cube.time.values, stored)
+    new = cube.isel(time=np.flatnonzero(~overlap))
+    if new.sizes["time"] and new.time.values[0] <= stored.max():
+        raise ValueError(
+            f"Can only append months after {stored.max()} to the cube at {location}"
+        )
+
+    # months already in the store are rewritten in place
+    writes = []
+    static = [name for name in cube.variables if "time" not in cube[name].dims]
+    for i in np.flatnonzero(overlap):
+        j = int(np.flatnonzero(stored == cube.time.values[i])[0])
+        writes.append(
+            cube.isel(time=[i])
+            .drop_vars(static)
+            .to_zarr(location, region=dict(time=slice(j, j + 1)), compute=compute)
+        )
+
+    if new.sizes["time"]:
+        writes.append(
+            new.to_zarr(location, append_dim="time", consolidated=True, compute=compute)
+        )
+
+    return [] if compute else writes
+
+
+def _store(cube: xr.Dataset, location: str, chunks=None, folded=None) -> xr.Dataset:
+    """
+    Write ``cube`` to ``location``, then record ``folded``, the month and
+    dataset ids of an update. In memory right away, else as part of the
+    graph: every variable of the returned cube waits for them in its last
+    block.
+    """
+    if not dask.is_dask_collection(cube):
+        write_cube(cube, location, chunks=chunks)
+        if folded is not None:
+            record_datasets(location, *folded)
+        return cube
+
+    cube = cube.chunk(dict(time=1, obs=-1, **(chunks or {})))
+    writes = write_cube(cube, location, chunks=chunks, compute=False)
+    if folded is not None:
+        writes = [dask.delayed(_record_after)(writes, location, *folded)]
+
+    return cube.assign(
+        {name: wait_for(var, writes) for name, var in cube.data_vars.items()}
+    )
+
+
+def _record_after(written, location: str, month: np.datetime64, ids: Set[str]):
+    record_datasets(location, month, ids)
+
+
+def write_monthly_cube(
+    ndvi: xr.DataArray,
+    template: str,
+    rolling_window: int,
+    chunks=None,
+) -> xr.Dataset:
+    """
+    Build the tile's cube for the months in ``ndvi``, continuing smoothing
+    from the previous month if the cube has it, and write it. A Dask backed
+    cube is written when the returned one is computed.
+    """
+    location = cube_location(template, ndvi.geobox)
+    start = ndvi.spec["time"].values.astype("datetime64[M]").min()
+
+    tail = previous_tail(location, start, chunks=chunks)
+    return _store(monthly_cube(ndvi, rolling_window, tail=tail), location, chunks)
+
+
+def read_monthly_cube(
+    template: str,
+    datasets: Sequence[Dataset],
+    geobox: GeoBox,
+    chunks=None,
+) -> xr.Dataset:
+    """
+    The tile's cube for the months covered by ``datasets``.
+    """
+    start, end = month_range(datasets)
+    return read_cube(cube_location(template, geobox), start, end, chunks=chunks)
+
+
+def folded_datasets(cube: xr.Dataset, month: np.datetime64) -> Set[str]:
+    """
+    Ids of the datasets folded into ``month`` of ``cube`` by updates.
+    """
+    key = str(np.datetime64(month, "M"))
+    return set(cube.attrs.get("datasets", {}).get(key, []))
+
+
+def record_datasets(location: str, month: np.datetime64, ids: Iterable[str]):
+    """
+    Record ``ids`` as the datasets folded into ``month`` of the cube at
+    ``location``.
+    """
+    root = zarr.open_group(location, mode="r+")
+    datasets = dict(root.attrs.get("datasets", {}))
+    datasets[str(np.datetime64(month, "M"))] = sorted(ids)
+    root.attrs["datasets"] = datasets
+    zarr.consolidate_metadata(location)
+
+
+def new_datasets(
+    template: str, datasets: Sequence[Dataset], geobox: GeoBox
+) -> List[Dataset]:
+    """
+    Datasets of the latest month of ``datasets`` to fold into the tile's
+    cube: none if all of them are folded in already, the ones that aren't if
+    they are all from solar days after the last folded observation, else
+    all of them so the month is rebuilt.
+    """
+    location = cube_location(template, geobox)
+    _, month = month_range(datasets)
+
+    cube = open_cube(location)
+    if cube is None or month.astype("datetime64[ns]") not in cube.time.values:
+        return list(datasets)
+
+    folded = folded_datasets(cube, month)
+    unfolded = [ds for ds in datasets if str(ds.id) not in folded]
+    if not unfolded:
+        return []
+
+    # same solar day offset the plugins group observations with
+    offset = np.timedelta64(solar_offset(geobox.extent))
+    last = cube.last_obs.sel(time=month.astype("datetime64[ns]")).values
+    last = (last + offset).astype("datetime64[D]")
+
+    def day(ds):
+        time = np.datetime64(normalise_dt(ds.center_time)) + offset
+        return time.astype("datetime64[D]")
+
+    if all(day(ds) > last for ds in unfolded):
+        return unfolded
+
+    # a late scene of a day already folded in
+    return list(datasets)
+
+
+def update_monthly_cube(
+    ndvi: xr.DataArray,
+    template: str,
+    rolling_window: int,
+    chunks=None,
+    datasets: Sequence[str] = (),
+) -> xr.Dataset:
+    """
+    Fold ``ndvi`` into the tile's cube for its month and write it, a Dask
+    backed month is written when the returned one is computed.
+
+    Observations after the last folded one are added to the month's sums,
+    otherwise ``ndvi`` must hold the whole month, which is rebuilt.
+    ``datasets`` are the ids of the datasets ``ndvi`` was loaded from, they
+    are recorded as folded into the month.
+    """
+    location = cube_location(template, ndvi.geobox)
+    times = ndvi.spec["time"].values
+    months = np.unique(times.astype("datetime64[M]"))
+    if len(months) != 1:
+        raise ValueError("The cube can only be updated one month at a time")
+    month = months[0]
+
+    cube = open_cube(location, chunks=chunks)
+    stored = None
+    if cube is not None and month.astype("datetime64[ns]") in cube.time.values:
+        stored = cube.sel(time=[month.astype("datetime64[ns]")])
+
+    folded: Set[str] = set()
+    if stored is not None and times.min() > stored.last_obs.values[0]:
+        folded = folded_datasets(cube, month)
+        update = monthly_cube(
+            ndvi, rolling_window, tail=stored.ndvi_tail.isel(time=0, drop=True)
+        )
+        for name in ("ndvi_sum", "ndvi_sumsq", "clear_count"):
+            update[name] = (update[name] + stored[name]).astype(update[name].dtype)
+    else:
+        # a new month, or ``ndvi`` goes back over folded days and rebuilds it
+        tail = previous_tail(location, month, chunks=chunks)
+        update = monthly_cube(ndvi, rolling_window, tail=tail)
+
+    return _store(update, location, chunks, folded=(month, folded | set(datasets)))
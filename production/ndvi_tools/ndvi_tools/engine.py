@@ -0,0 +1,99 @@
+"""
+Choice between the Dask and the in-memory NumPy execution of a tile.
+
+Small and sparse tiles spend more time scheduling the Dask graph built by
+``load_with_native_transform`` and the xarray reductions than doing the
+arithmetic. Loading them without chunks runs the same code on NumPy arrays
+instead, so results are those of the Dask path without the graph. The
+default ``auto`` picks NumPy for tiles up to ``numpy_max_gib``.
+
+The one place where blocks show through is ``mask_cleanup``: on Dask it
+runs block by block with a halo of the largest radius only, which is too
+little for a sequence of operations, so masks differ near block edges
+from a run over the whole array. ``mask_cleanup_blocks`` runs in-memory
+masks the same way, over the blocks the Dask path would have. Reductions
+go through the same smoothing kernels and accumulate in ``float64`` (see
+``smoothing``), so outputs of both engines are identical.
+"""
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+from odc.algo._masking import mask_cleanup, mask_cleanup_np
+
+ENGINES = ("auto", "dask", "numpy")
+
+DEFAULT_ENGINE = "auto"
+
+
+def use_numpy(engine: str, read_bytes: int, max_numpy_bytes: float) -> bool:
+    """
+    Whether a tile estimated to read ``read_bytes`` runs on NumPy arrays.
+    """
+    if engine == "auto":
+        return read_bytes <= max_numpy_bytes
+
+    return engine == "numpy"
+
+
+def chunks_for(
+    xx: xr.Dataset, chunks: Optional[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """
+    ``chunks`` for data that is Dask backed, ``None`` so anything loaded to
+    go with in-memory data stays in memory too.
+    """
+    return chunks if dask.is_dask_collection(xx) else None
+
+
+def _after(block: np.ndarray, *written) -> np.ndarray:
+    return block
+
+
+def wait_for(band: xr.DataArray, writes: Sequence[Any]) -> xr.DataArray:
+    """
+    Dask backed ``band`` with its last block depending on the delayed
+    ``writes``, so computing it runs them. The other blocks are free as
+    soon as they are done.
+    """
+    blocks = np.empty(band.data.numblocks, dtype=object)
+    for idx in np.ndindex(*blocks.shape):
+        blocks[idx] = band.data.blocks[idx]
+    last = blocks[(-1,) * blocks.ndim]
+    blocks[(-1,) * blocks.ndim] = da.from_delayed(
+        dask.delayed(_after)(last, *writes), last.shape, dtype=last.dtype
+    )
+    return band.copy(data=da.block(blocks.tolist()))
+
+
+def mask_cleanup_blocks(
+    mask: xr.DataArray,
+    mask_filters: Iterable[Tuple[str, int]],
+    chunks: Optional[Dict[str, int]] = None,
+) -> xr.DataArray:
+    """
+    ``mask_cleanup`` of ``mask``. In memory it is run over the (y, x)
+    ``chunks`` the Dask path would have, each with the halo ``mask_cleanup``
+    gives a Dask block, so block edges come out the same on both engines.
+    """
+    if dask.is_dask_collection(mask.data) or not chunks:
+        return mask_cleanup(mask, mask_filters=mask_filters)
+
+    mask_filters = list(mask_filters)
+    depth = max(radius for _, radius in mask_filters)
+    (ny, nx), (cy, cx) = mask.shape[-2:], (chunks["y"], chunks["x"])
+    data = mask.data
+    out = np.empty_like(data)
+    for y in range(0, ny, cy):
+        for x in range(0, nx, cx):
+            y0, x0 = max(y - depth, 0), max(x - depth, 0)
+            block = mask_cleanup_np(
+                data[..., y0 : y + cy + depth, x0 : x + cx + depth], mask_filters
+            )
+            out[..., y : y + cy, x : x + cx] = block[
+                ..., y - y0 : y - y0 + cy, x - x0 : x - x0 + cx
+            ]
+
+    return mask.copy(data=out)
@@ -0,0 +1,134 @@
+"""
+Single pass fusing of same-day observations.
+
+The default plugin fuser calls ``_xr_fuse`` twice, once to pick the first
+valid value of every reflectance band and once to OR the cloud mask, each
+call building its own intermediate arrays. The kernel here does both in one
+traversal of the overlapping scenes and writes into preallocated outputs.
+"""
+from typing import Sequence, Tuple, Union
+
+import dask
+import dask.array as da
+import numba
+import numpy as np
+import xarray as xr
+from dask.base import tokenize
+
+
+@numba.njit(nogil=True, cache=True)
+def _first_valid_or_nb(bands, mask, nodata, nan_nodata, out, out_mask):
+    """
+    bands: tuple of (time, y, x) arrays sharing one dtype
+    mask: (time, y, x) array
+    out: (band, y, x) preallocated output for the fused bands
+    out_mask: (y, x) preallocated output for the fused mask
+    """
+    nt, ny, nx = mask.shape
+    nb = len(bands)
+    for iy in range(ny):
+        for ix in range(nx):
+            m = mask[0, iy, ix]
+            for it in range(1, nt):
+                m = m | mask[it, iy, ix]
+            out_mask[iy, ix] = m
+
+            for ib in range(nb):
+                b = bands[ib]
+                v = nodata
+                for it in range(nt):
+                    x = b[it, iy, ix]
+                    if (x == x) if nan_nodata else (x != nodata):
+                        v = x
+                        break
+                out[ib, iy, ix] = v
+
+
+def first_valid_or_np(
+    bands: Sequence[np.ndarray], mask: np.ndarray, nodata: Union[int, float] = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fuse along the first axis: first valid value for every band, OR for mask.
+
+    Equivalent to ``_first_valid_np`` applied to every band plus
+    ``_fuse_or_np`` applied to the mask, but in a single pass. Outputs keep a
+    leading axis of length 1. Bands must share one dtype.
+    """
+    bands = tuple(np.ascontiguousarray(b) for b in bands)
+    mask = np.ascontiguousarray(mask)
+    dtype = bands[0].dtype
+    _, ny, nx = mask.shape
+
+    out = np.empty((len(bands), 1, ny, nx), dtype=dtype)
+    out_mask = np.empty((1, ny, nx), dtype=mask.dtype)
+    nodata = dtype.type(nodata)
+    _first_valid_or_nb(
+        bands, mask, nodata, bool(np.isnan(nodata)), out[:, 0], out_mask[0]
+    )
+
+    return out, out_mask
+
+
+def _first_valid_or_packed(*blocks, nodata):
+    # last block is the mask, pack it as an extra band so dask sees one output
+    *bands, mask = blocks
+    out, out_mask = first_valid_or_np(bands, mask, nodata=nodata)
+    return np.concatenate([out[:, 0], out_mask.astype(out.dtype)])
+
+
+def _da_first_valid_or(
+    bands: Sequence[da.Array], mask: da.Array, nodata: Union[int, float]
+) -> Tuple[Tuple[da.Array, ...], da.Array]:
+    dtype = bands[0].dtype
+    args = []
+    for a in (*bands, mask):
+        args.extend([a, "tyx"])
+
+    # "t" is contracted, so every task sees the whole group for its y/x block
+    packed = da.blockwise(
+        _first_valid_or_packed,
+        "byx",
+        *args,
+        new_axes={"b": len(bands) + 1},
+        concatenate=True,
+        dtype=dtype,
+        nodata=nodata,
+        name="fuse_first_valid_or-" + tokenize(*bands, mask, nodata),
+    )
+    fused = tuple(packed[i : i + 1] for i in range(len(bands)))
+    fused_mask = packed[len(bands) :].astype(mask.dtype)
+
+    return fused, fused_mask
+
+
+def xr_first_valid_or(
+    xx: xr.Dataset, mask_band: str = "cloud_mask", nodata: Union[int, float] = 0
+) -> xr.Dataset:
+    """
+    Fuse a group of same-day observations in a single pass.
+
+    Every band apart from ``mask_band`` takes the first value not equal to
+    ``nodata``, ``mask_band`` is OR-ed across the group. All bands other
+    than ``mask_band`` must share one dtype.
+    """
+    band_names = [n for n in xx.data_vars if n != mask_band]
+    mask = xx[mask_band]
+    if mask.shape[0] <= 1:
+        return xx
+
+    if len({xx[n].dtype for n in band_names}) != 1:
+        raise ValueError("Single pass fuser expects all bands to share one dtype")
+
+    bands = [xx[n].data for n in band_names]
+    if dask.is_dask_collection(mask.data):
+        fused, fused_mask = _da_first_valid_or(bands, mask.data, nodata)
+    else:
+        out, out_mask = first_valid_or_np(bands, mask.data, nodata=nodata)
+        fused, fused_mask = tuple(out), out_mask
+
+    fused_vars = dict(zip(band_names, fused))
+    fused_vars[mask_band] = fused_mask
+
+    # first observation of the group provides coordinates and attributes
+    out = xx.isel({mask.dims[0]: slice(0, 1)})
+    return out.copy(data=fused_vars)
@@ -1,20 +1,54 @@
 import json
+import math
+from collections import Counter
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+from uuid import UUID
 
 import click
 import fsspec
 import pandas as pd
 import toolz
+from datacube.model import GridSpec
 from datacube.utils.geometry import Geometry
 from odc.aws.queue import get_queue, publish_messages
 from odc.dscache import DatasetCache
+from odc.dscache._dscache import mk_group_name
+from odc.dscache.tools.tiling import GRIDS
 from odc.stats.tasks import render_sqs
 
+from .subtiles import DEFAULT_CHUNKS, estimate_read_bytes, subtile_shape
+
 # Load the ndvi_clim.csv from the relative path
 here = Path(__file__).parent
 ALL_TILES = set(pd.read_csv(here / "ndvi_clim.csv")["region_code"])
 
+# Grid of the regular run, ALL_TILES are region codes on it
+TILE_GRID = "africa_30"
+
+# Expected resource class by estimated bytes read, first match wins
+RESOURCE_CLASSES = (
+    ("small", 20 * 2**30),
+    ("medium", 80 * 2**30),
+    ("large", None),
+)
+
+
+class TileCost(NamedTuple):
+    tile: Tuple
+    region_code: str
+    datasets: int
+    products: Dict[str, int]
+    read_bytes: int
+    subtiles: Tuple[int, int] = (1, 1)
+
+    @property
+    def resource_class(self) -> str:
+        for name, limit in RESOURCE_CLASSES:
+            if limit is None or self.read_bytes <= limit:
+                return name
+        return RESOURCE_CLASSES[-1][0]
+
 
 def get_geometry(geojson_file: str) -> Geometry:
     with fsspec.open(geojson_file) as f:
@@ -25,14 +59,41 @@ def get_geometry(geojson_file: str) -> Geometry:
     )
 
 
-def filter_tiles(dataset_cache: DatasetCache, limit: Optional[int] = None):
-    tiles = dataset_cache.tiles("africa_30")
+def covers_any_tile(gridspec: GridSpec, tile_idx: Tuple[int, int]) -> bool:
+    """
+    Whether a tile of a larger grid, e.g. for a preview run, overlaps any
+    of ALL_TILES.
+    """
+    tiles = GRIDS[TILE_GRID]
+    if gridspec.crs != tiles.crs:
+        raise ValueError(f"Grid must be in {tiles.crs} like {TILE_GRID}")
+
+    bbox = gridspec.tile_geobox(tile_idx).extent.boundingbox
+    xs = range(
+        math.floor((bbox.left - tiles.origin[1]) / tiles.tile_size[1]),
+        math.ceil((bbox.right - tiles.origin[1]) / tiles.tile_size[1]),
+    )
+    ys = range(
+        math.floor((bbox.bottom - tiles.origin[0]) / tiles.tile_size[0]),
+        math.ceil((bbox.top - tiles.origin[0]) / tiles.tile_size[0]),
+    )
+    return any(f"x{x:03d}y{y:03d}" in ALL_TILES for x in xs for y in ys)
+
+
+def filter_tiles(
+    dataset_cache: DatasetCache, limit: Optional[int] = None, grid: str = TILE_GRID
+):
+    tiles = dataset_cache.tiles(grid)
+    gridspec = dataset_cache.grids[grid]
     count = 0
 
     for tile in tiles:
-        tile_id = f"x{tile[0][1]:03d}y{tile[0][2]:03d}"
+        if grid == TILE_GRID:
+            keep = f"x{tile[0][1]:03d}y{tile[0][2]:03d}" in ALL_TILES
+        else:
+            keep = covers_any_tile(gridspec, tile[0][1:])
 
-        if tile_id in ALL_TILES:
+        if keep:
             count += 1
             yield tile
 
@@ -40,20 +101,125 @@ def filter_tiles(dataset_cache: DatasetCache, limit: Optional[int] = None):
                 break
 
 
+def product_index(dataset_cache: DatasetCache) -> Dict[UUID, str]:
+    """
+    Product of every dataset in the cache, read once for all the tiles.
+    """
+    return {ds.id: ds.type.name for ds in dataset_cache.get_all()}
+
+
+def tile_products(
+    dataset_cache: DatasetCache,
+    tile_idx: Tuple,
+    index: Mapping[UUID, str],
+    grid: str = TILE_GRID,
+) -> Dict[str, int]:
+    """
+    Number of datasets of each product in a tile of the cache.
+    """
+    uuids = dataset_cache.get_group(mk_group_name(tile_idx, grid)) or []
+    return dict(Counter(index[uuid] for uuid in uuids))
+
+
+def tile_cost(
+    dataset_cache: DatasetCache,
+    tile,
+    grid: str = TILE_GRID,
+    max_subtile_bytes: Optional[float] = None,
+    index: Optional[Mapping[UUID, str]] = None,
+) -> TileCost:
+    """
+    Estimate the cost of a tile from the cache index, without loading its
+    datasets: the bytes read for the tile's datasets of each product.
+    ``index`` is the cache's ``product_index``, built if not given. Tiles
+    above ``max_subtile_bytes`` are split into sub-tiles by the plugins.
+    """
+    tile_idx, datasets = tile
+    if index is None:
+        index = product_index(dataset_cache)
+    gridspec = dataset_cache.grids[grid]
+    shape = tuple(
+        round(size / abs(res))
+        for size, res in zip(gridspec.tile_size, gridspec.resolution)
+    )
+    products = tile_products(dataset_cache, tile_idx, index, grid=grid)
+    read_bytes = estimate_read_bytes(products, math.prod(shape))
+
+    return TileCost(
+        tile=tile_idx,
+        region_code=f"x{tile_idx[1]:03d}y{tile_idx[2]:03d}",
+        datasets=datasets,
+        products=products,
+        read_bytes=read_bytes,
+        subtiles=subtile_shape(read_bytes, max_subtile_bytes, shape, DEFAULT_CHUNKS),
+    )
+
+
+def sort_tiles_by_cost(
+    dataset_cache: DatasetCache,
+    tiles,
+    max_subtile_bytes: Optional[float] = None,
+    grid: str = TILE_GRID,
+) -> List[TileCost]:
+    """
+    Heaviest tiles first, so they don't end up last and dominate the makespan.
+    """
+    index = product_index(dataset_cache)
+    costs = [
+        tile_cost(
+            dataset_cache,
+            tile,
+            grid=grid,
+            max_subtile_bytes=max_subtile_bytes,
+            index=index,
+        )
+        for tile in tiles
+    ]
+    return sorted(costs, key=lambda c: c.read_bytes, reverse=True)
+
+
+def print_cost_report(costs: List[TileCost]):
+    totals = Counter(c.resource_class for c in costs)
+
+    print(f"{'tile':<10}{'datasets':>10}{'GiB':>10}{'split':>7}  {'class':<8}products")
+    for c in costs:
+        split = "{}x{}".format(*c.subtiles)
+        products = " ".join(f"{p}={n}" for p, n in sorted(c.products.items()))
+        print(
+            f"{c.region_code:<10}{c.datasets:>10}{c.read_bytes / 2**30:>10.1f}"
+            f"{split:>7}  {c.resource_class:<8}{products}"
+        )
+
+    datasets = sum(c.datasets for c in costs)
+    total_bytes = sum(c.read_bytes for c in costs)
+    print(f"{'total':<10}{datasets:>10}{total_bytes / 2**30:>10.1f}")
+    print(
+        "Tiles per resource class: "
+        + ", ".join(f"{name}={totals[name]}" for name, _ in RESOURCE_CLASSES)
+    )
+
+
 def publish_tasks(
     dataset_cache: DatasetCache,
     queue,
     remote_db_file: str,
     dry_run: bool = False,
     limit: Optional[int] = None,
+    max_subtile_bytes: Optional[float] = None,
+    grid: str = TILE_GRID,
 ):
     messages = []
 
-    tiles = filter_tiles(dataset_cache, limit=limit)
-    for n, tile in enumerate(tiles):
-        tile, _ = tile
+    # limit to the most expensive tiles, not to the first ones in the cache
+    costs = sort_tiles_by_cost(
+        dataset_cache,
+        filter_tiles(dataset_cache, grid=grid),
+        max_subtile_bytes=max_subtile_bytes,
+        grid=grid,
+    )[:limit]
+    for n, cost in enumerate(costs):
         message = dict(
-            Id=str(n), MessageBody=json.dumps(render_sqs(tile, remote_db_file))
+            Id=str(n), MessageBody=json.dumps(render_sqs(cost.tile, remote_db_file))
         )
         messages.append(message)
 
@@ -62,6 +228,7 @@ def publish_tasks(
             publish_messages(queue, bunch)
         print(f"Published {len(messages)} messages")
     else:
+        print_cost_report(costs)
         print(f"DRYRUN! Would have published {len(messages)} messages")
 
 
@@ -71,14 +238,39 @@ def publish_tasks(
 @click.argument("queue_name", type=str)
 @click.option("--dry-run", is_flag=True, default=False)
 @click.option("--limit", type=int, default=0)
-def main(db_file, remote_db_file, queue_name, dry_run, limit):
+@click.option(
+    "--max-subtile-gib",
+    type=float,
+    default=0,
+    help="Plugins' max_subtile_gib, used to report how heavy tiles are split",
+)
+@click.option(
+    "--grid",
+    type=str,
+    default=TILE_GRID,
+    help="Grid of the cache's tasks, a larger grid gives a few large-area tasks "
+    "covering the same tiles, e.g. for a preview_resolution run",
+)
+def main(db_file, remote_db_file, queue_name, dry_run, limit, max_subtile_gib, grid):
     queue = get_queue(queue_name)
     dataset_cache = DatasetCache.open_ro(db_file)
 
     if limit == 0:
         limit = None
 
-    publish_tasks(dataset_cache, queue, remote_db_file, dry_run=dry_run, limit=limit)
+    max_subtile_bytes = None
+    if max_subtile_gib > 0:
+        max_subtile_bytes = max_subtile_gib * 2**30
+
+    publish_tasks(
+        dataset_cache,
+        queue,
+        remote_db_file,
+        dry_run=dry_run,
+        limit=limit,
+        max_subtile_bytes=max_subtile_bytes,
+        grid=grid,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+"""
+Continental overview mosaic, written together with the plugins' outputs.
+
+Every band of a tile's output is decimated by each of the pyramid's
+factors while the full resolution result is still in memory, and written
+into a zarr store covering the continent with one group per level, e.g.
+``mosaic.zarr/8/ndvi_mean``. The group attributes hold the level's ``crs``
+and ``transform``. Level arrays are chunked by tile, so a tile writes
+exactly one chunk per level and band, keyed by its position on the tile
+grid, in a single task, and tiles can be written concurrently. zarr
+rewrites a whole chunk on a partial write, so parts of one chunk are never
+written by separate tasks. Building the web overviews and mosaics then
+doesn't need another pass over every tile.
+
+The store is created once before the tasks run, with ``ndvi-mosaic``, and
+tasks only write into existing arrays. Creating it from concurrent tasks
+would race on object stores. The anomaly's ``mosaic_location`` is
+formatted with the output time, e.g. ``ndvi_anomaly_mosaic/{time:%Y-%m}.zarr``,
+so ``ndvi-mosaic`` needs ``--time`` for it. Previews (``preview_resolution``)
+aren't aligned with the tile grid and can't write a mosaic.
+
+Float bands are averaged over their valid pixels, integer bands (the
+clear counts) are summed, leaving out their nodata value.
+"""
+from typing import Sequence, Tuple
+
+import click
+import dask
+import fsspec
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+import zarr
+from affine import Affine
+from datacube.utils.geometry import GeoBox
+from odc.dscache.tools.tiling import GRIDS
+from odc.stats.plugins import resolve
+
+from .cube import tile_index
+from .engine import wait_for
+
+MOSAIC_GRID = "africa_30"
+
+# decimation factors of the pyramid levels, i.e. 240m, 960m and 3840m pixels
+MOSAIC_LEVELS = (8, 32, 128)
+
+# tile index ranges of MOSAIC_GRID covered by the mosaic, end exclusive,
+# these contain all the tiles in ndvi_clim.csv
+MOSAIC_TILES = dict(x=(156, 233), y=(33, 124))
+
+COUNT_NODATA = -1
+
+
+def tile_pixels(grid: str = MOSAIC_GRID) -> int:
+    gs = GRIDS[grid]
+    return int(round(gs.tile_size[1] / abs(gs.resolution[1])))
+
+
+def level_geobox(factor: int, grid: str = MOSAIC_GRID) -> GeoBox:
+    """
+    Geobox of the whole mosaic at the level decimated by ``factor``.
+    """
+    gs = GRIDS[grid]
+    resolution = abs(gs.resolution[1]) * factor
+    (x0, x1), (y0, y1) = MOSAIC_TILES["x"], MOSAIC_TILES["y"]
+    left = gs.origin[1] + x0 * gs.tile_size[1]
+    top = gs.origin[0] + y1 * gs.tile_size[0]
+    n = tile_pixels(grid) // factor
+    return GeoBox(
+        (x1 - x0) * n,
+        (y1 - y0) * n,
+        Affine(resolution, 0, left, 0, -resolution, top),
+        gs.crs,
+    )
+
+
+def decimate(band: xr.DataArray, factor: int) -> xr.DataArray:
+    """
+    ``band`` decimated by ``factor``, averaged if float and summed if integer.
+    """
+    if np.issubdtype(band.dtype, np.floating):
+        return band.coarsen(y=factor, x=factor).mean().astype(np.float32)
+
+    nodata = band.attrs.get("nodata")
+    if nodata is not None:
+        band = band.where(band != nodata, 0)
+    return band.coarsen(y=factor, x=factor).sum().astype(np.int32)
+
+
+def create_mosaic(
+    location: str,
+    bands: Sequence[Tuple[str, np.dtype]],
+    levels: Sequence[int] = MOSAIC_LEVELS,
+    grid: str = MOSAIC_GRID,
+) -> zarr.Group:
+    """
+    Create the mosaic at ``location`` with an array for every level and
+    output band of ``bands`` (name, dtype), once before the tasks writing
+    into it run. Existing arrays are kept.
+    """
+    root = zarr.open_group(location, mode="a")
+    for factor in levels:
+        geobox = level_geobox(factor, grid)
+        level = root.require_group(str(factor))
+        level.attrs.update(crs=str(geobox.crs), transform=list(geobox.transform)[:6])
+
+        n = tile_pixels(grid) // factor
+        for name, dtype in bands:
+            floating = np.issubdtype(dtype, np.floating)
+            zarr.open_array(
+                location,
+                mode="a",
+                path=f"{factor}/{name}",
+                shape=geobox.shape,
+                chunks=(n, n),
+                dtype=np.float32 if floating else np.int32,
+                fill_value=np.nan if floating else COUNT_NODATA,
+            )
+
+    return root
+
+
+def _write_chunk(location: str, path: str, data: np.ndarray, row: int, col: int):
+    array = zarr.open_array(location, mode="r+", path=path)
+    array[row : row + data.shape[0], col : col + data.shape[1]] = data
+    return data.shape
+
+
+def write_mosaic(
+    ds: xr.Dataset,
+    location: str,
+    levels: Sequence[int] = MOSAIC_LEVELS,
+    grid: str = MOSAIC_GRID,
+) -> xr.Dataset:
+    """
+    Write the decimated bands of a tile's output ``ds`` into the mosaic at
+    ``location``, created beforehand with ``create_mosaic``.
+
+    In memory outputs are written right away. Otherwise the writes join the
+    graph of ``ds``, so they are computed from the same blocks as the output
+    instead of reading it back. Every level of a band is written by one
+    task from all its blocks, and only the last block of the returned band
+    depends on those writes, the others are free as soon as they are done.
+    """
+    n = tile_pixels(grid)
+    if any(n % factor for factor in levels):
+        raise ValueError(f"Mosaic levels {levels} must divide the tile size {n}")
+
+    geobox = ds.geobox
+    x, y = tile_index(geobox, grid)
+    if geobox != GRIDS[grid].tile_geobox((x, y)):
+        raise ValueError(f"Output isn't aligned with a tile of {grid}")
+    (x0, x1), (y0, y1) = MOSAIC_TILES["x"], MOSAIC_TILES["y"]
+    if not (x0 <= x < x1 and y0 <= y < y1):
+        raise ValueError(f"Tile x{x:03d}y{y:03d} is outside of the mosaic")
+
+    try:
+        zarr.open_group(location, mode="r")
+    except (ValueError, FileNotFoundError):
+        raise ValueError(f"No mosaic at {location}, create it with ndvi-mosaic")
+
+    after_writes = {}
+    for name, band in ds.data_vars.items():
+        tile = band.isel(time=0, drop=True) if "time" in band.dims else band
+        writes = []
+        for factor in levels:
+            # rows run north to south, tile y indices south to north
+            row, col = (y1 - 1 - y) * (n // factor), (x - x0) * (n // factor)
+            data = decimate(tile, factor).data
+            if dask.is_dask_collection(data):
+                writes.append(
+                    dask.delayed(_write_chunk)(
+                        location, f"{factor}/{name}", data, row, col
+                    )
+                )
+            else:
+                _write_chunk(location, f"{factor}/{name}", data, row, col)
+
+        if not writes:
+            continue
+
+        after_writes[name] = wait_for(band, writes)
+
+    return ds.assign(after_writes) if after_writes else ds
+
+
+@click.command("ndvi-mosaic")
+@click.argument("config", type=str)
+@click.option(
+    "--time",
+    type=str,
+    default=None,
+    help="Month of an anomaly run, e.g. 2022-01, its mosaic_location is formatted with it",
+)
+def main(config, time):
+    """
+    Create the mosaic of the plugin configured in the odc-stats CONFIG file,
+    once before its tasks run.
+    """
+    with fsspec.open(config) as f:
+        cfg = yaml.safe_load(f)
+
+    plugin = resolve(cfg["plugin"])(**cfg.get("plugin_config", {}))
+    if plugin.mosaic_location is None:
+        raise click.UsageError(f"No mosaic_location in {config}")
+
+    if time is None and "{time" in plugin.mosaic_location:
+        raise click.UsageError(f"{plugin.mosaic_location} needs --time")
+
+    location = plugin.mosaic_location.format(time=pd.Timestamp(time))
+    create_mosaic(location, plugin.mosaic_bands, plugin.mosaic_levels)
+    click.echo(f"Created {location}")
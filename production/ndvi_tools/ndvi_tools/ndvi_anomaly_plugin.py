@@ -1,7 +1,7 @@
+from concurrent.futures import Future
 from functools import partial
 from typing import Any, Dict, Iterable, Optional, Sequence, Tuple
 
-import datacube
 import numpy as np
 import pandas as pd
 import xarray as xr
@@ -15,6 +15,30 @@ from odc.stats.plugins import StatsPluginInterface
 from odc.stats.plugins._registry import register
 from toolz import get_in
 
+from .ancillary import MONTHS, fetched, load_climatology, load_wofs_mask, prefetch
+from .cube import (
+    CUBE_MODES,
+    UPDATE_MODE,
+    new_datasets,
+    read_monthly_cube,
+    update_monthly_cube,
+    write_monthly_cube,
+)
+from .engine import (
+    DEFAULT_ENGINE,
+    ENGINES,
+    chunks_for,
+    mask_cleanup_blocks,
+    use_numpy,
+)
+from .fuser import xr_first_valid_or
+from .mosaic import MOSAIC_LEVELS, write_mosaic
+from .precision import NDVI_DTYPES, encode_ndvi
+from .preview import load_with_coarse_transform, preview_filters, preview_geobox
+from .reader import configure_reader, load_concurrently
+from .smoothing import smoothed_sums
+from .subtiles import estimate_read_bytes, reduce_by_subtile, subtile_shape
+
 
 class NDVIAnomaly(StatsPluginInterface):
     NAME = "NDVIAnomaly"
@@ -55,6 +79,18 @@ class NDVIAnomaly(StatsPluginInterface):
         scale: float = 0.0000275,
         offset: float = -0.2,
         output_dtype: str = "float32",
+        single_pass_fuser: bool = False,
+        max_subtile_gib: Optional[float] = None,
+        prefetch_ancillary: bool = True,
+        cube_mode: Optional[str] = None,
+        cube_location: Optional[str] = None,
+        engine: str = DEFAULT_ENGINE,
+        numpy_max_gib: float = 1.0,
+        ndvi_dtype: str = "float32",
+        preview_resolution: Optional[float] = None,
+        max_concurrent_reads: Optional[int] = None,
+        mosaic_location: Optional[str] = None,
+        mosaic_levels: Tuple[int, ...] = MOSAIC_LEVELS,
         output_bands: Tuple[str, ...] = (
             "ndvi_mean",
             "ndvi_std_anomaly",
@@ -85,15 +121,79 @@ class NDVIAnomaly(StatsPluginInterface):
         self.offset = offset
         self.output_dtype = np.dtype(output_dtype)
         self.output_nodata = np.nan
+        self.single_pass_fuser = single_pass_fuser
+        self.max_subtile_bytes = None
+        if max_subtile_gib is not None:
+            self.max_subtile_bytes = max_subtile_gib * 2**30
+        self.prefetch_ancillary = prefetch_ancillary
+        self._prefetched: Optional[Tuple[GeoBox, Dict[str, Future]]] = None
+        if cube_mode not in (None, UPDATE_MODE) + CUBE_MODES:
+            raise ValueError(f"cube_mode must be one of {CUBE_MODES + (UPDATE_MODE,)}")
+        if cube_mode is not None and cube_location is None:
+            raise ValueError("cube_location is required with cube_mode")
+        self.cube_mode = cube_mode
+        self.cube_location = cube_location
+        if engine not in ENGINES:
+            raise ValueError(f"engine must be one of {ENGINES}")
+        self.engine = engine
+        self.max_numpy_bytes = numpy_max_gib * 2**30
+        if ndvi_dtype not in NDVI_DTYPES:
+            raise ValueError(f"ndvi_dtype must be one of {NDVI_DTYPES}")
+        self.ndvi_dtype = ndvi_dtype
+        if preview_resolution is not None and cube_mode is not None:
+            raise ValueError("preview_resolution can't be used with cube_mode")
+        self.preview_resolution = preview_resolution
+        self.max_concurrent_reads = max_concurrent_reads
+        if max_concurrent_reads is not None:
+            # odc-stats runs its Dask workers as threads of this process
+            configure_reader(max_concurrent_reads)
+        if preview_resolution is not None and mosaic_location is not None:
+            raise ValueError("preview_resolution can't be used with mosaic_location")
+        self.mosaic_location = mosaic_location
+        self.mosaic_levels = tuple(mosaic_levels)
 
     @property
     def measurements(self) -> Tuple[str, ...]:
         return self.output_bands
 
+    @property
+    def mosaic_bands(self) -> Tuple[Tuple[str, np.dtype], ...]:
+        return tuple(
+            (name, np.dtype(np.int16 if name == "clear_count" else np.float32))
+            for name in self.output_bands
+        )
+
     def input_data(self, datasets: Sequence[Dataset], geobox: GeoBox) -> xr.Dataset:
         """
         Load
         """
+        self._prefetched = None
+        if self.cube_mode == "read":
+            # the monthly NDVI cube replaces the surface reflectance
+            return read_monthly_cube(
+                self.cube_location, datasets, geobox, chunks=self.work_chunks
+            )
+
+        if self.cube_mode == UPDATE_MODE:
+            # only load scenes that arrived since the last provisional update
+            new = new_datasets(self.cube_location, datasets, geobox)
+            if not new:
+                return read_monthly_cube(
+                    self.cube_location, datasets, geobox, chunks=self.work_chunks
+                )
+            datasets = new
+
+        # same pipeline on a coarsened geobox, read from COG overviews
+        load = load_with_native_transform
+        mask_filters = self.mask_filters
+        missed_cloud_filters = [("dilation", 5)]
+        if self.preview_resolution is not None:
+            load = load_with_coarse_transform
+            geobox = preview_geobox(geobox, self.preview_resolution)
+            mask_filters = preview_filters(mask_filters, self.preview_resolution)
+            missed_cloud_filters = preview_filters(
+                missed_cloud_filters, self.preview_resolution
+            )
 
         def masking_data_ls(xx, flags):
 
@@ -110,7 +210,10 @@ class NDVIAnomaly(StatsPluginInterface):
 
             # remove cloud that fmask misses
             missed_cloud = xx["blue"] >= 20910  # i.e. > 0.375
-            missed_cloud = mask_cleanup(missed_cloud, mask_filters=[("dilation", 5)])
+            if missed_cloud_filters:
+                missed_cloud = mask_cleanup(
+                    missed_cloud, mask_filters=missed_cloud_filters
+                )
 
             mask_band = xx[self.mask_band_ls89]
             xx = xx.drop_vars([self.mask_band_ls89])
@@ -120,9 +223,7 @@ class NDVIAnomaly(StatsPluginInterface):
             # set cloud_mask - True=cloud, False=non-cloud
             mask, _ = masking.create_mask_value(flags_def, **flags)
             cloud_mask = (mask_band & mask) != 0
-            cloud_mask = xr.ufuncs.logical_or(
-                cloud_mask, missed_cloud
-            )  # combine with cloud mask
+            cloud_mask = cloud_mask | missed_cloud  # combine with cloud mask
 
             # set no_data bitmask - True=data, False=no-data
             nodata_mask, _ = masking.create_mask_value(
@@ -163,6 +264,8 @@ class NDVIAnomaly(StatsPluginInterface):
 
             return xx
 
+        loaded = [str(ds.id) for ds in datasets]
+
         # seperate datsets into different sensors
         product_dss = {}
         for dataset in datasets:
@@ -171,6 +274,17 @@ class NDVIAnomaly(StatsPluginInterface):
                 product_dss[product] = []
             product_dss[product].append(dataset)
 
+        # small tiles are loaded and reduced in memory, without Dask
+        read_bytes = estimate_read_bytes(
+            {product: len(dss) for product, dss in product_dss.items()},
+            geobox.shape[0] * geobox.shape[1],
+        )
+        chunks = self.work_chunks
+        if use_numpy(self.engine, read_bytes, self.max_numpy_bytes):
+            chunks = None
+        # look up the ancillaries while the imagery is, in memory read them too
+        self._prefetch(geobox, min(ds.center_time for ds in datasets).month, chunks)
+
         # Separate out LS89 datasets from s2
         ls_dss = []
         if "ls8_sr" in product_dss:
@@ -182,34 +296,37 @@ class NDVIAnomaly(StatsPluginInterface):
         # Loading data needs to handle either LS or S-2 datasets might
         # not be present, but we can assume that at least one of them will
         # due to how the dataset cache creation works.
-        products = {}
+        loads = {}
         # Load Landsats 8 and 9
         if len(ls_dss) > 0:
-            ls89 = load_with_native_transform(
+            loads["ls89"] = partial(
+                load,
                 dss=ls_dss,
                 geobox=geobox,
                 native_transform=lambda x: masking_data_ls(x, self.flags_ls89),
                 bands=self.input_bands_ls89,
                 groupby=self.group_by,
                 fuser=self.fuser,
-                chunks=self.work_chunks,
+                chunks=chunks,
                 resampling=self.resampling,
             )
-            products["ls89"] = ls89
 
         # Load Sentinel-2
         if "s2_l2a" in product_dss:
-            s2 = load_with_native_transform(
+            loads["s2"] = partial(
+                load,
                 dss=product_dss["s2_l2a"],
                 geobox=geobox,
                 native_transform=lambda x: masking_data_s2(x, self.flags_s2),
                 bands=self.input_bands_s2,
                 groupby=self.group_by,
                 fuser=self.fuser,
-                chunks=self.work_chunks,
+                chunks=chunks,
                 resampling=self.resampling,
             )
-            products["s2"] = s2
+
+        # sensors are loaded side by side, sharing the read pool if enabled
+        products = load_concurrently(loads)
 
         # Loop through products, rescale, calculate NDVI
         for key, datasets in products.items():
@@ -217,8 +334,10 @@ class NDVIAnomaly(StatsPluginInterface):
             cloud_mask = datasets["cloud_mask"]
 
             # Morphological operators on cloud layer to improve it
-            if self.mask_filters is not None:
-                cloud_mask = mask_cleanup(cloud_mask, mask_filters=self.mask_filters)
+            if mask_filters:
+                cloud_mask = mask_cleanup_blocks(
+                    cloud_mask, mask_filters, self.work_chunks
+                )
 
             # erase pixels with dilated cloud
             datasets = datasets.drop_vars(["cloud_mask"])
@@ -260,73 +379,162 @@ class NDVIAnomaly(StatsPluginInterface):
         # Remove NDVI values that aren't between 0 and 1
         ndvi = ndvi.where((ndvi >= 0) & (ndvi <= 1))
 
+        # carry the stack at reduced precision until reduce decodes it
+        ndvi["ndvi"] = encode_ndvi(ndvi.ndvi, self.ndvi_dtype)
+
+        # flag heavy tiles so reduce processes them one sub-tile at a time
+        ndvi.attrs["subtiles"] = subtile_shape(
+            read_bytes,
+            self.max_subtile_bytes,
+            geobox.shape,
+            None if chunks is None else (chunks["y"], chunks["x"]),
+        )
+        if self.cube_mode == UPDATE_MODE:
+            # recorded in the cube as folded in by reduce
+            ndvi.attrs["cube_datasets"] = loaded
+
         return ndvi
 
+    def _prefetch(self, geobox: GeoBox, m: int, chunks: Optional[Dict[str, int]]):
+        """
+        Start loading the ancillaries of the tile in the background. With
+        ``chunks`` only the datacube lookups run, their reads join the graph.
+        """
+        if self.prefetch_ancillary:
+            self._prefetched = geobox, dict(
+                clim=prefetch(
+                    load_climatology,
+                    geobox,
+                    MONTHS[m - 1],
+                    self.min_num_obs,
+                    resampling=self.resampling,
+                    dask_chunks=chunks,
+                ),
+                wofs=prefetch(
+                    load_wofs_mask, geobox, self.wofs_threshold, dask_chunks=chunks
+                ),
+            )
+
+    def _take_prefetched(self, xx: xr.Dataset) -> Optional[Dict[str, Future]]:
+        """
+        Ancillaries prefetched by input_data for the tile of ``xx``, if any
+        """
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is None or prefetched[0] != xx.geobox:
+            return None
+        return prefetched[1]
+
     def reduce(self, xx: xr.Dataset) -> xr.Dataset:
-        """ """
-        # create boolean of valid obs (not NaNs)
-        cc = xr.ufuncs.isnan(xx.ndvi)
-        cc = xr.ufuncs.logical_not(cc)  # invert
-        cc = cc.to_dataset(name="clear_count")
-        xx_pq = cc.sum("spec")
-
-        # smooth timeseries with rolling mean
-        # doing this AFTER clear count as rolling mean changes # of obs.
-        xx["ndvi"] = xx.ndvi.rolling(spec=self.rolling_window, min_periods=1).mean()
-
-        # remask so rolling mean doesn't change # of obs
-        xx["ndvi"] = xx["ndvi"].where(cc["clear_count"])
-
-        # mapping month names with month int
-        months = {
-            "jan": 1,
-            "feb": 2,
-            "mar": 3,
-            "apr": 4,
-            "may": 5,
-            "jun": 6,
-            "jul": 7,
-            "aug": 8,
-            "sep": 9,
-            "oct": 10,
-            "nov": 11,
-            "dec": 12,
-        }
-
-        # find the month and year we've loaded from time dim,
-        # this is used to load the right month from ndvi-clim
-        # and to append time dimension to output
-        m = xx.spec["time"].dt.month.values[0]
-        y = str(xx.spec["time"].dt.year.values[0])
-        time = pd.date_range(np.datetime64(y + "-" + f"{m:02d}"), periods=1, freq="M")
+        """
+        Reduce the whole tile, or one sub-tile at a time if input_data
+        flagged it as heavy. In cube modes reduce from the monthly NDVI cube,
+        in update mode after folding the new scenes into it. Decimated
+        outputs go to the continental mosaic if there is one.
+        """
+        shape = xx.attrs.pop("subtiles", (1, 1))
+        loaded = xx.attrs.pop("cube_datasets", ())
+        ancillary = self._take_prefetched(xx)
+        if self.cube_mode == "write":
+            xx = write_monthly_cube(
+                xx.ndvi,
+                self.cube_location,
+                self.rolling_window,
+                chunks_for(xx, self.work_chunks),
+            )
+        elif self.cube_mode == UPDATE_MODE and "ndvi" in xx.data_vars:
+            xx = update_monthly_cube(
+                xx.ndvi,
+                self.cube_location,
+                self.rolling_window,
+                chunks_for(xx, self.work_chunks),
+                datasets=loaded,
+            )
+        _reduce = partial(self._reduce, ancillary=ancillary)
+        if "ndvi_sum" in xx.data_vars:
+            anom = self._reduce_cube(xx, ancillary=ancillary)
+        elif tuple(shape) == (1, 1):
+            anom = _reduce(xx)
+        else:
+            anom = reduce_by_subtile(
+                _reduce, xx, shape, chunks=chunks_for(xx, self.work_chunks)
+            )
 
-        # get month we're loading as abbreviated str
-        month = list(months.keys())[list(months.values()).index(m)]
-
-        # hard-code loading of ndvi_climatology_ls as doesn't
-        # fit with odc-stat save-tasks paradigm
-        dc = datacube.Datacube(app="Vegetation_anomalies")
-        ndvi_clim = (
-            dc.load(
-                product="ndvi_climatology_ls",
-                like=xx.geobox,
-                measurements=["mean_" + month, "stddev_" + month, "count_" + month],
-                dask_chunks=self.work_chunks,
-                resampling=self.resampling,
+        if self.mosaic_location is not None:
+            time = pd.Timestamp(anom.time.values[0])
+            anom = write_mosaic(
+                anom, self.mosaic_location.format(time=time), self.mosaic_levels
             )
-            .squeeze()
-            .drop("time")
-        )  # Remove time dimension
 
-        # --Make a quality assurance mask where clear observation count is low
-        #  in the ndvi-climatology product ----
-        qa_mask = ndvi_clim["count_" + month] >= self.min_num_obs
+        return anom
 
-        # remove pixels where obs are < min_num_obs
-        ndvi_clim = ndvi_clim.where(qa_mask)
+    def _reduce(
+        self, xx: xr.Dataset, ancillary: Optional[Dict[str, Any]] = None
+    ) -> xr.Dataset:
+        """ """
+        # clear count and sum of the smoothed time series, straight from the
+        # encoded NDVI
+        sums = smoothed_sums(xx.ndvi, self.rolling_window)
+        xx_pq = sums.clear_count.to_dataset()
 
         # calculate the mean NDVI for the month
-        xx_mean = xx.mean("spec")
+        mean = sums.ndvi_sum / sums.clear_count
+        xx_mean = mean.astype(self.output_dtype).to_dataset(name="ndvi")
+
+        m = xx.spec["time"].dt.month.values[0]
+        y = xx.spec["time"].dt.year.values[0]
+        return self._anomaly(xx_mean, xx_pq, m, y, ancillary=ancillary)
+
+    def _reduce_cube(
+        self, cube: xr.Dataset, ancillary: Optional[Dict[str, Any]] = None
+    ) -> xr.Dataset:
+        """
+        Mean NDVI and clear count for the month from the monthly NDVI cube
+        """
+        cube = cube.isel(time=0)
+        m, y = int(cube.time.dt.month), int(cube.time.dt.year)
+        cube = cube.drop_vars("time")
+
+        mean = cube.ndvi_sum / cube.clear_count
+        xx_mean = mean.astype(self.output_dtype).to_dataset(name="ndvi")
+        xx_pq = cube.clear_count.to_dataset(name="clear_count")
+
+        return self._anomaly(xx_mean, xx_pq, m, y, ancillary=ancillary)
+
+    def _anomaly(
+        self,
+        xx_mean: xr.Dataset,
+        xx_pq: xr.Dataset,
+        m: int,
+        y: int,
+        ancillary: Optional[Dict[str, Any]] = None,
+    ) -> xr.Dataset:
+        """
+        Standardised anomaly of the monthly mean against the climatology
+        """
+        # the month and year we've loaded are used to load the right month
+        # from ndvi-clim and to append time dimension to output
+        time = pd.date_range(f"{y}-{m:02d}", periods=1, freq=pd.offsets.MonthEnd())
+
+        # get month we're loading as abbreviated str
+        month = MONTHS[m - 1]
+
+        # hard-code loading of ndvi_climatology_ls and WOfS as they don't
+        # fit with odc-stat save-tasks paradigm, use the prefetched ones if any
+        chunks = chunks_for(xx_mean, self.work_chunks)
+        if ancillary is not None:
+            ndvi_clim = fetched(ancillary["clim"], xx_mean)
+            wofs = fetched(ancillary["wofs"], xx_mean)
+        else:
+            ndvi_clim = load_climatology(
+                xx_mean.geobox,
+                month,
+                self.min_num_obs,
+                resampling=self.resampling,
+                dask_chunks=chunks,
+            )
+            wofs = load_wofs_mask(
+                xx_mean.geobox, self.wofs_threshold, dask_chunks=chunks
+            )
 
         # calculate anomaly
         anomalies = xr.apply_ufunc(
@@ -334,7 +542,7 @@ class NDVIAnomaly(StatsPluginInterface):
             xx_mean,
             ndvi_clim["mean_" + month],
             ndvi_clim["stddev_" + month],
-            output_dtypes=[xx.ndvi.dtype],
+            output_dtypes=[xx_mean.ndvi.dtype],
             dask="allowed",
         )
 
@@ -356,20 +564,6 @@ class NDVIAnomaly(StatsPluginInterface):
         anom = assign_crs(anom, crs="epsg:6933")  # Add geobox
 
         # --mask with all-time WOfS to remove permanent waterbodies---
-        wofs = dc.load(
-            product="wofs_ls_summary_alltime",
-            measurements=["frequency"],
-            like=xx.geobox,
-            dask_chunks=self.work_chunks,
-        ).frequency.squeeze()
-
-        # set masked terrain regions to 0
-        wofs = xr.where(xr.ufuncs.isnan(wofs), 0, wofs)
-
-        # threshold to create waterbodies mask
-        wofs = wofs < self.wofs_threshold
-
-        # mask
         anom = anom.where(wofs)
 
         # enforce dtypes (masking auto-changes to float64)
@@ -381,8 +575,12 @@ class NDVIAnomaly(StatsPluginInterface):
 
     def fuser(self, xx):
         """
-        Fuse cloud_mask with OR
+        Fuse cloud_mask with OR, bands with first valid.
         """
+        if self.single_pass_fuser:
+            # one traversal of the group instead of one per fuse op
+            return xr_first_valid_or(xx, mask_band="cloud_mask", nodata=0)
+
         cloud_mask = xx["cloud_mask"]
         xx = _xr_fuse(
             xx.drop_vars(["cloud_mask"]), partial(_first_valid_np, nodata=0), ""
@@ -1,8 +1,9 @@
+from concurrent.futures import Future
 from functools import partial
 from typing import Any, Dict, Iterable, Optional, Sequence, Tuple
 
-import datacube
 import numpy as np
+import pandas as pd
 import xarray as xr
 from datacube.model import Dataset
 from datacube.utils import masking
@@ -14,6 +15,25 @@ from odc.stats.plugins import StatsPluginInterface
 from odc.stats.plugins._registry import register
 from toolz import get_in
 
+from .ancillary import MONTHS, fetched, load_wofs_mask, prefetch
+from .cube import CUBE_MODES, read_monthly_cube, write_monthly_cube
+from .engine import (
+    DEFAULT_ENGINE,
+    ENGINES,
+    chunks_for,
+    mask_cleanup_blocks,
+    use_numpy,
+)
+from .fuser import xr_first_valid_or
+from .mosaic import MOSAIC_LEVELS, write_mosaic
+from .precision import NDVI_DTYPES, encode_ndvi
+from .preview import load_with_coarse_transform, preview_filters, preview_geobox
+from .reader import configure_reader
+from .smoothing import smoothed_sums
+from .subtiles import estimate_read_bytes, reduce_by_subtile, subtile_shape
+
+STATS = ("mean", "stddev")
+
 
 class NDVIClimatology(StatsPluginInterface):
     NAME = "NDVIClimatology"
@@ -45,6 +65,19 @@ class NDVIClimatology(StatsPluginInterface):
         scale: float = 0.0000275,
         offset: float = -0.2,
         output_dtype: str = "float32",
+        single_pass_fuser: bool = False,
+        max_subtile_gib: Optional[float] = None,
+        prefetch_ancillary: bool = True,
+        count_nodata: int = -999,
+        cube_mode: Optional[str] = None,
+        cube_location: Optional[str] = None,
+        engine: str = DEFAULT_ENGINE,
+        numpy_max_gib: float = 1.0,
+        ndvi_dtype: str = "float32",
+        preview_resolution: Optional[float] = None,
+        max_concurrent_reads: Optional[int] = None,
+        mosaic_location: Optional[str] = None,
+        mosaic_levels: Tuple[int, ...] = MOSAIC_LEVELS,
         output_bands: Tuple[str, ...] = (
             "mean_jan",
             "mean_feb",
@@ -105,17 +138,73 @@ class NDVIClimatology(StatsPluginInterface):
         self.offset = offset
         self.output_dtype = np.dtype(output_dtype)
         self.output_nodata = np.nan
+        self.single_pass_fuser = single_pass_fuser
+        self.max_subtile_bytes = None
+        if max_subtile_gib is not None:
+            self.max_subtile_bytes = max_subtile_gib * 2**30
+        self.prefetch_ancillary = prefetch_ancillary
+        self._prefetched: Optional[Tuple[GeoBox, Future]] = None
+        self.count_nodata = count_nodata
+        if cube_mode not in (None,) + CUBE_MODES:
+            raise ValueError(f"cube_mode must be one of {CUBE_MODES}")
+        if cube_mode is not None and cube_location is None:
+            raise ValueError("cube_location is required with cube_mode")
+        self.cube_mode = cube_mode
+        self.cube_location = cube_location
+        if engine not in ENGINES:
+            raise ValueError(f"engine must be one of {ENGINES}")
+        self.engine = engine
+        self.max_numpy_bytes = numpy_max_gib * 2**30
+        if ndvi_dtype not in NDVI_DTYPES:
+            raise ValueError(f"ndvi_dtype must be one of {NDVI_DTYPES}")
+        self.ndvi_dtype = ndvi_dtype
+        if preview_resolution is not None and cube_mode is not None:
+            raise ValueError("preview_resolution can't be used with cube_mode")
+        self.preview_resolution = preview_resolution
+        self.max_concurrent_reads = max_concurrent_reads
+        if max_concurrent_reads is not None:
+            # odc-stats runs its Dask workers as threads of this process
+            configure_reader(max_concurrent_reads)
+        if preview_resolution is not None and mosaic_location is not None:
+            raise ValueError("preview_resolution can't be used with mosaic_location")
+        self.mosaic_location = mosaic_location
+        self.mosaic_levels = tuple(mosaic_levels)
 
     @property
     def measurements(self) -> Tuple[str, ...]:
         return self.output_bands
 
+    @property
+    def mosaic_bands(self) -> Tuple[Tuple[str, np.dtype], ...]:
+        return tuple(
+            (name, np.dtype(np.int16 if name.startswith("count_") else np.float32))
+            for name in self.output_bands
+        )
+
     def input_data(self, datasets: Sequence[Dataset], geobox: GeoBox) -> xr.Dataset:
         """
         Load each of the sensors, remove cloud and poor data,
         apply scaling coefficients to LS5 & 7 NDVI to mimic
         NDVI of Landsat 8. Return the harmonized NDVI time series
         """
+        self._prefetched = None
+        if self.cube_mode == "read":
+            # the monthly NDVI cube replaces the surface reflectance
+            return read_monthly_cube(
+                self.cube_location, datasets, geobox, chunks=self.work_chunks
+            )
+
+        # same pipeline on a coarsened geobox, read from COG overviews
+        load = load_with_native_transform
+        mask_filters = self.filters
+        missed_cloud_filters = [("dilation", 5)]
+        if self.preview_resolution is not None:
+            load = load_with_coarse_transform
+            geobox = preview_geobox(geobox, self.preview_resolution)
+            mask_filters = preview_filters(mask_filters, self.preview_resolution)
+            missed_cloud_filters = preview_filters(
+                missed_cloud_filters, self.preview_resolution
+            )
 
         def masking_data(xx, flags):
             """
@@ -141,7 +230,10 @@ class NDVIClimatology(StatsPluginInterface):
 
             # remove cloud that fmask misses
             missed_cloud = xx["blue"] >= 20910  # i.e. > 0.375
-            missed_cloud = mask_cleanup(missed_cloud, mask_filters=[("dilation", 5)])
+            if missed_cloud_filters:
+                missed_cloud = mask_cleanup(
+                    missed_cloud, mask_filters=missed_cloud_filters
+                )
 
             mask_band = xx[self.mask_band]
             xx = xx.drop_vars([self.mask_band])
@@ -151,9 +243,7 @@ class NDVIClimatology(StatsPluginInterface):
             # set cloud_mask - True=cloud, False=non-cloud
             mask, _ = masking.create_mask_value(flags_def, **flags)
             cloud_mask = (mask_band & mask) != 0
-            cloud_mask = xr.ufuncs.logical_or(
-                cloud_mask, missed_cloud
-            )  # combine with 'missed_cloud'
+            cloud_mask = cloud_mask | missed_cloud  # combine with 'missed_cloud'
 
             # set no_data bitmask - True=data, False=no-data
             nodata_mask, _ = masking.create_mask_value(flags_def, **self.nodata_flags)
@@ -178,6 +268,17 @@ class NDVIClimatology(StatsPluginInterface):
                 product_dss[product] = []
             product_dss[product].append(dataset)
 
+        # small tiles are loaded and reduced in memory, without Dask
+        read_bytes = estimate_read_bytes(
+            {product: len(dss) for product, dss in product_dss.items()},
+            geobox.shape[0] * geobox.shape[1],
+        )
+        chunks = self.work_chunks
+        if use_numpy(self.engine, read_bytes, self.max_numpy_bytes):
+            chunks = None
+        # look up WOfS while the imagery is, in memory read it too
+        self._prefetch(geobox, chunks)
+
         # Separate out LS5,7 datasets
         ls57_dss = []
         if "ls5_sr" in product_dss:
@@ -189,28 +290,28 @@ class NDVIClimatology(StatsPluginInterface):
         # load landsat 5 and/or 7. We need to wrap this in a
         # try-except because some tiles don't have ls57 data
         try:
-            ls57 = load_with_native_transform(
+            ls57 = load(
                 dss=ls57_dss,
                 geobox=geobox,
                 native_transform=lambda x: masking_data(x, self.flags_ls57),
                 bands=self.input_bands,
                 groupby=self.group_by,
                 fuser=self.fuser,
-                chunks=self.work_chunks,
+                chunks=chunks,
                 resampling=self.resampling,
             )
         except ValueError:
             pass
 
         # load Landsat 8
-        ls8 = load_with_native_transform(
+        ls8 = load(
             dss=product_dss["ls8_sr"],
             geobox=geobox,
             native_transform=lambda x: masking_data(x, self.flags_ls8),
             bands=self.input_bands,
             groupby=self.group_by,
             fuser=self.fuser,
-            chunks=self.work_chunks,
+            chunks=chunks,
             resampling=self.resampling,
         )
 
@@ -235,8 +336,10 @@ class NDVIClimatology(StatsPluginInterface):
             cloud_mask = ds[k]["cloud_mask"]
 
             # morphological operators on cloud dataset to improve it
-            if self.filters is not None:
-                cloud_mask = mask_cleanup(cloud_mask, mask_filters=self.filters)
+            if mask_filters:
+                cloud_mask = mask_cleanup_blocks(
+                    cloud_mask, mask_filters, self.work_chunks
+                )
 
             # erase pixels with dilated cloud
             ds[k] = ds[k].drop_vars(["cloud_mask"])  # "keeps"
@@ -275,100 +378,157 @@ class NDVIClimatology(StatsPluginInterface):
         # Remove NDVI's that aren't between 0 and 1
         ndvi = ndvi.where((ndvi >= 0) & (ndvi <= 1))
 
+        # carry the stack at reduced precision until reduce decodes it
+        ndvi["ndvi"] = encode_ndvi(ndvi.ndvi, self.ndvi_dtype)
+
+        # flag heavy tiles so reduce processes them one sub-tile at a time
+        ndvi.attrs["subtiles"] = subtile_shape(
+            read_bytes,
+            self.max_subtile_bytes,
+            geobox.shape,
+            None if chunks is None else (chunks["y"], chunks["x"]),
+        )
+
         return ndvi
 
+    def _prefetch(self, geobox: GeoBox, chunks: Optional[Dict[str, int]]):
+        """
+        Start loading WOfS for the tile in the background. With ``chunks``
+        only the datacube lookup runs, its reads join the graph.
+        """
+        if self.prefetch_ancillary:
+            wofs = prefetch(
+                load_wofs_mask, geobox, self.wofs_threshold, dask_chunks=chunks
+            )
+            self._prefetched = geobox, wofs
+
+    def _take_prefetched(self, xx: xr.Dataset) -> Optional[Future]:
+        """
+        WOfS prefetched by input_data for the tile of ``xx``, if any
+        """
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is None or prefetched[0] != xx.geobox:
+            return None
+        return prefetched[1]
+
     def reduce(self, xx: xr.Dataset) -> xr.Dataset:
+        """
+        Reduce the whole tile, or one sub-tile at a time if input_data
+        flagged it as heavy. In cube modes reduce from the monthly NDVI cube.
+        Decimated outputs go to the continental mosaic if there is one.
+        """
+        shape = xx.attrs.pop("subtiles", (1, 1))
+        wofs = self._take_prefetched(xx)
+        if self.cube_mode == "write":
+            xx = write_monthly_cube(
+                xx.ndvi,
+                self.cube_location,
+                self.rolling_window,
+                chunks_for(xx, self.work_chunks),
+            )
+        _reduce = partial(self._reduce, wofs=wofs)
+        if "ndvi_sum" in xx.data_vars:
+            clim = self._reduce_cube(xx, wofs=wofs)
+        elif tuple(shape) == (1, 1):
+            clim = _reduce(xx)
+        else:
+            clim = reduce_by_subtile(
+                _reduce, xx, shape, chunks=chunks_for(xx, self.work_chunks)
+            )
+
+        if self.mosaic_location is not None:
+            clim = write_mosaic(clim, self.mosaic_location, self.mosaic_levels)
+
+        return clim
+
+    def _reduce(self, xx: xr.Dataset, wofs: Optional[Future] = None) -> xr.Dataset:
         """
         Collapse the NDVI time series using mean
         and std. dev.
         """
-        # create boolean of valid obs (not NaNs)
-        cc = xr.ufuncs.isnan(xx.ndvi)
-        cc = xr.ufuncs.logical_not(cc)  # invert
-        cc = cc.to_dataset(name="clear_count")
-        xx_pq = cc.groupby(cc.spec["time.month"]).sum("spec")  # clear count per month
-
-        # smooth timeseries with rolling mean
-        # doing this AFTER clear count as rolling mean changes # of obs.
-        xx["ndvi"] = xx.ndvi.rolling(spec=self.rolling_window, min_periods=1).mean()
-
-        # remask so rolling mean doesn't change # of obs
-        xx["ndvi"] = xx["ndvi"].where(cc["clear_count"])
-
-        # Climatology calulations
-        months = {
-            "jan": [1],
-            "feb": [2],
-            "mar": [3],
-            "apr": [4],
-            "may": [5],
-            "jun": [6],
-            "jul": [7],
-            "aug": [8],
-            "sep": [9],
-            "oct": [10],
-            "nov": [11],
-            "dec": [12],
-        }
-
-        # calculate the climatologies for each month
-        xx_mean = xx.groupby(xx.spec["time.month"]).mean("spec")
-        xx_std = xx.groupby(xx.spec["time.month"]).std("spec")
-
-        # loop through months, select out arrays, rename
-        ndvi_var_mean = []
-        ndvi_var_std = []
-        pq = []
-        for m in months:
-            # mean
-            ix_mean = xx_mean.sel(month=months[m])
-            ix_mean = ix_mean.to_array(name="mean_" + m).drop("variable").squeeze()
-            ix_mean = ix_mean.astype(np.float32)
-
-            # std dev
-            ix_std = xx_std.sel(month=months[m])
-            ix_std = ix_std.to_array(name="stddev_" + m).drop("variable").squeeze()
-            ix_std = ix_std.astype(np.float32)
-
-            # count
-            ix_count = xx_pq.sel(month=months[m])
-            ix_count = ix_count.to_array(name="count_" + m).drop("variable").squeeze()
-            ix_count = ix_count.astype(np.int16)
-
-            # append da's to lists
-            ndvi_var_mean.append(ix_mean)
-            ndvi_var_std.append(ix_std)
-            pq.append(ix_count)
-
-        # merge them all into one dataset
-        clim = xr.merge(ndvi_var_mean + ndvi_var_std + pq, compat="override").drop(
-            "month"
+        # clear counts and sums of the smoothed time series per month,
+        # straight from the encoded NDVI
+        sums = smoothed_sums(xx.ndvi, self.rolling_window, key=xx.spec["time.month"])
+
+        return self._reduce_sums(sums, xx, wofs=wofs)
+
+    def _reduce_cube(
+        self, cube: xr.Dataset, wofs: Optional[Future] = None
+    ) -> xr.Dataset:
+        """
+        Climatologies for each month from the sums in the monthly NDVI cube
+        """
+        month = cube.time.dt.month
+        sums = (
+            cube[["clear_count", "ndvi_sum", "ndvi_sumsq"]].groupby(month).sum("time")
         )
 
-        # --mask with all-time WOfS to remove permanent waterbodies---
-        dc = datacube.Datacube(app="Vegetation_anomalies")
-        wofs = dc.load(
-            product="wofs_ls_summary_alltime",
-            measurements=["frequency"],
-            like=xx.geobox,
-            dask_chunks=self.work_chunks,
-        ).frequency.squeeze()
+        return self._reduce_sums(sums, cube, wofs=wofs)
 
-        # set masked terrain regions to 0
-        wofs = xr.where(xr.ufuncs.isnan(wofs), 0, wofs)
+    def _reduce_sums(
+        self, sums: xr.Dataset, like: xr.Dataset, wofs: Optional[Future] = None
+    ) -> xr.Dataset:
+        """
+        Climatologies from the clear counts and sums of each month
+        """
+        n = sums.clear_count
 
-        # threshold to create waterbodies mask
-        wofs = wofs < self.wofs_threshold
+        # population std. dev. as xarray's std, clipped against round-off
+        xx_mean = sums.ndvi_sum / n
+        xx_std = np.sqrt((sums.ndvi_sumsq / n - xx_mean**2).clip(min=0))
 
-        # mask
-        clim = clim.where(wofs)
+        # stack statistics as (stat, month, y, x) in their final dtypes,
+        # missing months are NaN
+        all_months = range(1, len(MONTHS) + 1)
+        stats = xr.concat([xx_mean, xx_std], dim=pd.Index(STATS, name="stat"))
+        stats = stats.reindex(month=all_months).astype(np.float32)
+        counts = n.reindex(month=all_months, fill_value=0)
 
-        return clim
+        return self._climatology(stats, counts, like, wofs=wofs)
+
+    def _climatology(
+        self,
+        stats: xr.DataArray,
+        counts: xr.DataArray,
+        like: xr.Dataset,
+        wofs: Optional[Future] = None,
+    ) -> xr.Dataset:
+        """
+        Mask the (stat, month) stack and the counts and split them into bands
+        """
+        # --mask with all-time WOfS to remove permanent waterbodies---
+        chunks = chunks_for(stats, self.work_chunks)
+        if wofs is not None:
+            wofs = fetched(wofs, like)
+        else:
+            wofs = load_wofs_mask(like.geobox, self.wofs_threshold, dask_chunks=chunks)
+
+        # mask in the stacked layout, counts stay integers
+        stats = stats.where(wofs)
+        counts = counts.where(wofs, self.count_nodata).astype(np.int16)
+
+        # expose every (stat, month) slice as a named band, e.g. "mean_jan"
+        bands = {}
+        for band in self.output_bands:
+            stat, m = band.split("_")
+            m = MONTHS.index(m) + 1
+            if stat == "count":
+                bands[band] = counts.sel(month=m, drop=True).assign_attrs(
+                    nodata=self.count_nodata
+                )
+            else:
+                bands[band] = stats.sel(stat=stat, month=m, drop=True)
+
+        return xr.Dataset(bands)
 
     def fuser(self, xx):
         """
-        Fuse cloud_mask with OR
+        Fuse cloud_mask with OR, bands with first valid.
         """
+        if self.single_pass_fuser:
+            # one traversal of the group instead of one per fuse op
+            return xr_first_valid_or(xx, mask_band="cloud_mask", nodata=0)
+
         cloud_mask = xx["cloud_mask"]
         xx = _xr_fuse(
             xx.drop_vars(["cloud_mask"]), partial(_first_valid_np, nodata=0), ""
@@ -0,0 +1,98 @@
+"""
+Reduced-precision encoding of the intermediate NDVI stack.
+
+NDVI is restricted to [0, 1] by the time the stack leaves ``input_data``,
+so it can sit in memory as scaled ``uint16`` (or ``float16``) at half the
+size of ``float32``. The reductions decode it to ``float64`` one time
+slice at a time with ``decode_slice`` (see ``smoothing``), so a decoded
+stack is never held. ``decode_ndvi`` decodes a whole stack to ``float32``,
+the dtype of an unencoded stack, e.g. the few observations kept in the
+monthly cube's tail.
+
+Worst case error of one decoded observation, which also bounds the error
+of the monthly means, of the std. devs. and of the anomaly numerator:
+
+- ``uint16``: ``0.5 / 65534`` plus the ``float32`` rounding of the decoded
+  value, ``2**-25``, about ``7.7e-6``
+- ``float16``: half a unit in the last place at 1.0, ``2**-12``, about
+  ``2.4e-4``
+"""
+import dask
+import numpy as np
+import xarray as xr
+
+NDVI_DTYPES = ("float32", "uint16", "float16")
+
+# [0, 1] is mapped onto 0..UINT16_SCALE, the top value marks missing data
+UINT16_SCALE = 65534
+UINT16_NODATA = 65535
+
+MAX_ERROR = {
+    "float32": 0.0,
+    "uint16": 0.5 / UINT16_SCALE + 2.0**-25,
+    "float16": 2.0**-12,
+}
+
+
+def encode_ndvi(ndvi: xr.DataArray, dtype: str = "float32") -> xr.DataArray:
+    """
+    Encode ``ndvi`` in [0, 1] (NaN where missing) as ``dtype``.
+    """
+    if dtype == "float32":
+        return ndvi
+
+    if dtype == "float16":
+        return ndvi.astype(np.float16).assign_attrs(nodata=np.nan)
+
+    encoded = (ndvi * UINT16_SCALE).round().fillna(UINT16_NODATA)
+    return encoded.astype(np.uint16).assign_attrs(
+        nodata=UINT16_NODATA, scale_factor=1 / UINT16_SCALE
+    )
+
+
+def encode_like(ndvi: xr.DataArray, dtype) -> xr.DataArray:
+    """
+    Encode ``ndvi`` like a stack of ``dtype``, e.g. to extend that stack.
+    """
+    dtype = np.dtype(dtype)
+    if dtype in (np.uint16, np.float16):
+        return encode_ndvi(ndvi, dtype.name)
+    return ndvi.astype(dtype)
+
+
+def _decode_uint16(encoded: np.ndarray) -> np.ndarray:
+    decoded = encoded.astype(np.float32)
+    decoded /= UINT16_SCALE
+    for i in range(decoded.shape[0]):
+        decoded[i][encoded[i] == UINT16_NODATA] = np.nan
+    return decoded
+
+
+def decode_slice(encoded: np.ndarray) -> np.ndarray:
+    """
+    One time slice of an encoded stack as ``float64``, NaN where missing.
+    """
+    decoded = encoded.astype(np.float64)
+    if encoded.dtype == np.uint16:
+        decoded /= UINT16_SCALE
+        decoded[encoded == UINT16_NODATA] = np.nan
+    return decoded
+
+
+def decode_ndvi(ndvi: xr.DataArray) -> xr.DataArray:
+    """
+    Decode an encoded stack to ``float32`` with NaN where missing, a
+    ``float32`` stack is returned as is.
+    """
+    if ndvi.dtype == np.float16:
+        return ndvi.astype(np.float32).assign_attrs(nodata=np.nan)
+
+    if ndvi.dtype == np.uint16:
+        if dask.is_dask_collection(ndvi.data):
+            data = ndvi.data.map_blocks(_decode_uint16, dtype=np.float32)
+        else:
+            data = _decode_uint16(ndvi.data)
+        attrs = {k: v for k, v in ndvi.attrs.items() if k != "scale_factor"}
+        return ndvi.copy(data=data).assign_attrs(attrs, nodata=np.nan)
+
+    return ndvi
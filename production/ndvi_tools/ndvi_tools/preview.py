@@ -0,0 +1,133 @@
+"""
+Coarse resolution preview of the plugins' outputs.
+
+A preview runs the same masking and statistics on a coarsened geobox, e.g.
+300m instead of 30m. Imagery is read straight at the preview resolution
+rather than at native resolution and then reprojected, so the readers pick
+the matching COG overview and only a fraction of the pixels is fetched.
+Morphological filters are scaled so they cover about the same ground
+distance as at native resolution, and kept at one pixel or more. Imagery
+is read with the plugin's ``resampling``, flag bands (those with a
+``flags_definition``, e.g. ``QA_PIXEL`` and ``SCL``) with nearest.
+
+For a continental preview in minutes, save the tasks on a large-tile grid,
+publish them for that grid and run them with the preview config in
+``ndvi_tools/config``, e.g.::
+
+    odc-stats save-tasks --grid "epsg:6933;300;3200" ...
+    ndvi-task --grid epsg:6933_300_3200 ...
+    odc-stats run <tasks.db> --config ndvi_anomaly_preview.yaml --resolution 300
+
+``ndvi-task`` only keeps the large tiles overlapping ``ndvi_clim.csv``.
+``preview_resolution`` is a plugin setting and doesn't change the task
+geobox odc-stats writes the output for, so ``--resolution`` must always
+be passed with the same value.
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import xarray as xr
+from datacube import Datacube
+from datacube.model import Dataset
+from datacube.utils.geometry import GeoBox
+from odc.algo._grouper import group_by_nothing, solar_offset
+from odc.algo._masking import _nodata_fuser
+from odc.algo._warp import xr_reproject
+from odc.algo.io import _split_by_grid
+
+# resolution the plugins' mask filter radii are expressed in
+NATIVE_RESOLUTION = 30
+
+
+def preview_geobox(geobox: GeoBox, resolution: float) -> GeoBox:
+    """
+    ``geobox`` coarsened to ``resolution``, a geobox already at that
+    resolution or coarser is returned as is.
+    """
+    if abs(geobox.resolution[1]) >= resolution:
+        return geobox
+
+    return GeoBox.from_geopolygon(
+        geobox.extent, resolution=(-resolution, resolution), crs=geobox.crs
+    )
+
+
+def preview_filters(
+    mask_filters: Optional[Iterable[Tuple[str, int]]], resolution: float
+) -> Optional[List[Tuple[str, int]]]:
+    """
+    Scale filter radii from native to ``resolution`` pixels, keeping at
+    least one pixel so no filter is dropped.
+    """
+    if mask_filters is None:
+        return None
+
+    return [
+        (op, max(1, round(radius * NATIVE_RESOLUTION / resolution)))
+        for op, radius in mask_filters
+    ]
+
+
+def _coarse_load_geobox(geobox: GeoBox, ds: Dataset) -> GeoBox:
+    # native projection at output resolution, padded by a couple of pixels
+    resolution = abs(geobox.resolution[1])
+    return GeoBox.from_geopolygon(
+        geobox.extent.to_crs(ds.crs).buffer(2 * resolution),
+        resolution=(-resolution, resolution),
+        crs=ds.crs,
+    )
+
+
+def load_with_coarse_transform(
+    dss: Sequence[Dataset],
+    bands: Sequence[str],
+    geobox: GeoBox,
+    native_transform: Callable[[xr.Dataset], xr.Dataset],
+    groupby: Optional[str] = None,
+    fuser: Optional[Callable[[xr.Dataset], xr.Dataset]] = None,
+    resampling: str = "nearest",
+    chunks: Optional[Dict[str, int]] = None,
+) -> xr.Dataset:
+    """
+    ``load_with_native_transform`` reading every projection at the output
+    resolution instead of the native one. Bands are read with
+    ``resampling``, except bands with flag definitions, which are read
+    with nearest.
+    """
+    if fuser is None:
+        fuser = _nodata_fuser
+    if groupby is None:
+        groupby = "idx"
+
+    sources = group_by_nothing(list(dss), solar_offset(geobox.extent))
+    _chunks = None
+    if chunks is not None:
+        _chunks = tuple(chunks.get(ax, -1) for ax in ("y", "x"))
+
+    _xx = []
+    for srcs in _split_by_grid(sources):
+        (ds,) = srcs.data[0]
+        mm = ds.type.lookup_measurements(bands)
+        band_resampling = {"*": resampling}
+        band_resampling.update(
+            {name: "nearest" for name, m in mm.items() if "flags_definition" in m}
+        )
+        xx = Datacube.load_data(
+            srcs,
+            _coarse_load_geobox(geobox, ds),
+            mm,
+            resampling=band_resampling,
+            dask_chunks=chunks,
+        )
+        xx = native_transform(xx)
+        if groupby != "idx":
+            xx = xx.groupby(groupby).map(fuser)
+        _xx.append(xr_reproject(xx, geobox, chunks=_chunks, resampling=resampling))
+
+    if len(_xx) == 1:
+        return _xx[0]
+
+    xx = xr.concat(_xx, sources.dims[0])
+    if groupby != "idx":
+        xx = xx.groupby(groupby).map(fuser)
+
+    return xx
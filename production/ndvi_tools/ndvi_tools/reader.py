@@ -0,0 +1,260 @@
+"""
+Pooled raster reads for the plugins.
+
+A datacube reader driver (registered under ``datacube.plugins.io.read``)
+that, once enabled with ``configure_reader``:
+
+- bounds the number of raster reads in flight in a worker process, one
+  pool shared by all sensors and bands,
+- keeps recently used files open instead of re-opening them for every
+  chunk, so headers and tile indices of COGs are fetched once,
+- lets GDAL merge consecutive byte ranges of adjacent blocks into one
+  HTTP request,
+- counts opens, reads and bytes read, see ``read_metrics``.
+
+The pool is per process and the GDAL options only apply, through a
+``rasterio.Env``, while a pooled file is open, so the process environment
+is left alone. odc-stats runs its Dask workers as threads of the process
+that configures the plugin. Separate worker processes need their own
+``client.run(configure_reader, ...)``. Until then the driver hands out
+datacube's default data source.
+
+With a pool the anomaly plugin builds its Landsat and Sentinel-2 loads
+side by side, see ``load_concurrently``. Only in-memory loads read the two
+sensors at the same time there, Dask loads read when the graph runs. The
+metrics of every worker can be gathered with ``client.run(read_metrics)``.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import rasterio
+from datacube.drivers.datasource import GeoRasterReader, RasterShape, RasterWindow
+from datacube.storage._rio import (
+    BandDataSource,
+    RasterDatasetDataSource,
+    RasterioDataSource,
+    _rasterio_crs,
+)
+from datacube.utils.math import num2numpy
+from datacube.utils.rio import activate_from_config
+
+# GDAL options for COGs over HTTP, existing settings take precedence
+GDAL_READ_OPTIONS = {
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "VSI_CACHE": "TRUE",
+}
+
+_lock = threading.Lock()
+_state: Dict[str, object] = {}
+_metrics = dict(opens=0, cache_hits=0, reads=0, bytes=0, in_flight=0, max_in_flight=0)
+
+
+def configure_reader(max_concurrent_reads: int, max_open_files: int = 64):
+    """
+    Enable pooled reads in this process.
+    """
+    with _lock:
+        _state.clear()
+        _state.update(max_reads=max_concurrent_reads, max_open_files=max_open_files)
+
+
+def reader_enabled() -> bool:
+    with _lock:
+        return "max_reads" in _state
+
+
+def read_metrics() -> Dict[str, int]:
+    """
+    Opens, handle cache hits, reads and bytes read in this process, plus
+    the highest number of reads seen in flight at once.
+    """
+    with _lock:
+        return dict(_metrics)
+
+
+def reset_read_metrics():
+    with _lock:
+        for name in _metrics:
+            _metrics[name] = 0
+
+
+def _count(**increments):
+    with _lock:
+        for name, n in increments.items():
+            _metrics[name] += n
+        _metrics["max_in_flight"] = max(
+            _metrics["max_in_flight"], _metrics["in_flight"]
+        )
+
+
+def _read_slots() -> threading.BoundedSemaphore:
+    with _lock:
+        if "slots" not in _state:
+            _state["slots"] = threading.BoundedSemaphore(_state.get("max_reads", 1))
+        return _state["slots"]
+
+
+def _handles() -> "_HandleCache":
+    with _lock:
+        if "handles" not in _state:
+            _state["handles"] = _HandleCache(_state.get("max_open_files", 64))
+        return _state["handles"]
+
+
+def _gdal_env() -> rasterio.Env:
+    # only the options not set in the environment or the active rasterio.Env
+    current = rasterio.env.getenv() if rasterio.env.hasenv() else {}
+    return rasterio.Env(
+        **{
+            name: value
+            for name, value in GDAL_READ_OPTIONS.items()
+            if name not in os.environ and name not in current
+        }
+    )
+
+
+class _HandleCache:
+    """
+    Least recently used open files. A handle is only read by one thread at
+    a time and only closed once it is evicted and no longer in use.
+    """
+
+    def __init__(self, max_open_files: int):
+        self._max = max_open_files
+        self._lock = threading.Lock()
+        self._open: "OrderedDict[str, list]" = OrderedDict()
+
+    @contextmanager
+    def open(self, filename: str) -> Iterator[Tuple[rasterio.DatasetReader, object]]:
+        with self._lock:
+            entry = self._open.get(filename)
+            if entry is not None:
+                self._open.move_to_end(filename)
+                entry[2] += 1
+
+        if entry is None:
+            src = rasterio.open(filename, sharing=False)
+            _count(opens=1)
+            with self._lock:
+                entry = self._open.setdefault(filename, [src, threading.Lock(), 0])
+                entry[2] += 1
+            if entry[0] is not src:
+                src.close()  # another thread opened it first
+        else:
+            _count(cache_hits=1)
+
+        try:
+            yield entry[0], entry[1]
+        finally:
+            with self._lock:
+                entry[2] -= 1
+                self._evict()
+
+    def _evict(self):
+        for filename in list(self._open):
+            if len(self._open) <= self._max:
+                break
+            src, _, users = self._open[filename]
+            if users == 0:
+                del self._open[filename]
+                src.close()
+
+
+class PooledBandDataSource(BandDataSource):
+    """
+    Band reads that take a slot from the process wide pool, once the file
+    is free so no slot is held while waiting for another read of the file.
+    """
+
+    def read(
+        self,
+        window: Optional[RasterWindow] = None,
+        out_shape: Optional[RasterShape] = None,
+    ):
+        with self._lock, _read_slots():
+            _count(in_flight=1)
+            try:
+                data = self.source.ds.read(
+                    indexes=self.source.bidx, window=window, out_shape=out_shape
+                )
+            finally:
+                _count(in_flight=-1)
+
+        _count(reads=1, bytes=data.nbytes)
+        return data
+
+
+class PooledRasterioDataSource(RasterioDataSource):
+    """
+    ``RasterioDataSource`` opening files through the handle cache.
+    """
+
+    @contextmanager
+    def open(self) -> Iterator[GeoRasterReader]:
+        activate_from_config()
+
+        with _gdal_env(), _handles().open(str(self.filename)) as (src, lock):
+            try:
+                _rasterio_crs(src)
+                broken = src.transform.is_identity
+            except ValueError:
+                broken = True
+            if broken:
+                raise RuntimeError(
+                    f'Broken/missing geospatial data was found in file "{self.filename}"'
+                )
+
+            band = rasterio.band(src, self.get_bandnumber(src))
+            nodata = src.nodatavals[band.bidx - 1]
+            if nodata is None:
+                nodata = self.nodata
+
+            yield PooledBandDataSource(
+                band, nodata=num2numpy(nodata, band.dtype), lock=lock
+            )
+
+
+class PooledDatasetDataSource(PooledRasterioDataSource, RasterDatasetDataSource):
+    """
+    Data source for reading a band of a Data Cube Dataset through the pool.
+    """
+
+
+class ReaderDriver:
+    name = "ndvi_tools.reader"
+    protocols = ["file", "s3", "http", "https"]
+    formats = ["GeoTIFF"]
+
+    def supports(self, protocol: str, fmt: str) -> bool:
+        return protocol in self.protocols and fmt in self.formats
+
+    def new_datasource(self, band):
+        if reader_enabled():
+            return PooledDatasetDataSource(band)
+        return RasterDatasetDataSource(band)
+
+
+def rdr_driver_init() -> ReaderDriver:
+    return ReaderDriver()
+
+
+def load_concurrently(loads: Dict[str, Callable[[], object]]) -> Dict[str, object]:
+    """
+    Run independent ``loads`` at the same time, e.g. one per sensor, and
+    return their results under the same keys. Errors are raised in order.
+
+    Only in memory loads read concurrently here. Dask loads just build
+    their graphs side by side, their reads run when the graph is computed.
+    """
+    if len(loads) <= 1:
+        return {key: load() for key, load in loads.items()}
+
+    with ThreadPoolExecutor(max_workers=len(loads)) as pool:
+        futures = {key: pool.submit(load) for key, load in loads.items()}
+        return {key: future.result() for key, future in futures.items()}
@@ -0,0 +1,142 @@
+"""
+Smoothed NDVI statistics straight from the (encoded) NDVI stack.
+
+Both plugins and the monthly cube smooth the NDVI time series with a
+rolling mean of ``rolling_window`` observations, re-mask it to the clear
+ones, and reduce it to clear counts, sums and sums of squares per group
+of time slices (the month, the months of the year). The kernels here walk
+the time slices of a block, decoding each one to ``float64`` as it is
+read, so neither a decoded nor a smoothed stack is held in memory: in
+memory the slices go straight into the per-group sums, on Dask every
+smoothed block is summed as soon as it is computed.
+
+Every smoothed value is the mean of the same window in the same order on
+both engines, and sums are accumulated in ``float64``, so the NumPy and
+Dask engines, which add observations up in a different order, agree
+once the results are cast to ``float32``.
+"""
+from collections import deque
+from typing import Iterator, Optional, Sequence
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+from .precision import decode_slice, encode_like
+from .validity import clear_count
+
+
+def _smoothed(
+    data: np.ndarray, rolling_window: int, history: Sequence[np.ndarray] = ()
+) -> Iterator[np.ndarray]:
+    # rolling mean over the clear observations of the window, NaN where the
+    # observation itself isn't clear, like xarray's with min_periods=1
+    window = deque((decode_slice(h) for h in history), maxlen=rolling_window)
+    for t in range(data.shape[0]):
+        x = decode_slice(data[t])
+        window.append(x)
+        total = np.zeros_like(x)
+        n = np.zeros(x.shape, dtype=np.int16)
+        for obs in window:
+            clear = obs == obs
+            total += np.where(clear, obs, 0)
+            n += clear
+        with np.errstate(invalid="ignore", divide="ignore"):
+            yield np.where(x == x, total / n, np.nan)
+
+
+def _smooth_block(block: np.ndarray, rolling_window: int) -> np.ndarray:
+    out = np.empty(block.shape, dtype=np.float64)
+    for t, smooth in enumerate(_smoothed(block, rolling_window)):
+        out[t] = smooth
+    return out
+
+
+def _accumulate(
+    data: np.ndarray,
+    codes: np.ndarray,
+    ngroups: int,
+    rolling_window: int,
+    history: Sequence[np.ndarray] = (),
+):
+    shape = (ngroups,) + data.shape[1:]
+    count = np.zeros(shape, dtype=np.int16)
+    total = np.zeros(shape, dtype=np.float64)
+    sumsq = np.zeros(shape, dtype=np.float64)
+    for g, smooth in zip(codes, _smoothed(data, rolling_window, history)):
+        clear = smooth == smooth
+        smooth[~clear] = 0
+        count[g] += clear
+        total[g] += smooth
+        sumsq[g] += smooth * smooth
+    return count, total, sumsq
+
+
+def smoothed_sums(
+    ndvi: xr.DataArray,
+    rolling_window: int,
+    key: Optional[xr.DataArray] = None,
+    tail: Optional[xr.DataArray] = None,
+    dim: str = "spec",
+) -> xr.Dataset:
+    """
+    ``clear_count``, ``ndvi_sum`` and ``ndvi_sumsq`` of the smoothed
+    ``ndvi`` along ``dim``, for every group of ``key`` (labels along
+    ``dim``) or over all of it. ``tail``, the observations before ``ndvi``
+    along the same ``dim``, only feeds the smoothing.
+    """
+    ndvi = ndvi.transpose(dim, ...)
+    grouped = key is not None
+    if not grouped:
+        key = xr.DataArray(np.zeros(ndvi.sizes[dim], dtype=int), dims=dim)
+    key = key.rename(key.name or "group")
+    if tail is not None:
+        # smoothed from the same encoding as the observations
+        tail = encode_like(tail.transpose(dim, ...), ndvi.dtype)
+
+    if dask.is_dask_collection(ndvi.data):
+        data, ntail = ndvi.data, 0
+        if tail is not None:
+            ntail = tail.sizes[dim]
+            history = da.asarray(tail.data).rechunk((-1,) + data.chunks[1:])
+            data = da.concatenate([history, data], axis=0)
+        depth = {axis: 0 for axis in range(data.ndim)}
+        depth[0] = rolling_window - 1
+        smooth = data.map_overlap(
+            _smooth_block,
+            depth=depth,
+            boundary="none",
+            dtype=np.float64,
+            rolling_window=rolling_window,
+        )
+        smooth = xr.DataArray(smooth[ntail:], coords=ndvi.coords, dims=ndvi.dims)
+        groups = smooth.groupby(key)
+        sums = xr.Dataset(
+            dict(
+                clear_count=groups.map(clear_count, dim=dim),
+                ndvi_sum=groups.sum(dim),
+                ndvi_sumsq=(smooth**2).groupby(key).sum(dim),
+            )
+        )
+    else:
+        labels, codes = np.unique(key.values, return_inverse=True)
+        history = () if tail is None else np.asarray(tail.data)
+        count, total, sumsq = _accumulate(
+            np.asarray(ndvi.data), codes, len(labels), rolling_window, history
+        )
+        dims = (key.name,) + ndvi.dims[1:]
+        coords = {k: v for k, v in ndvi.coords.items() if dim not in v.dims}
+        coords[key.name] = labels
+        sums = xr.Dataset(
+            dict(
+                clear_count=(dims, count),
+                ndvi_sum=(dims, total),
+                ndvi_sumsq=(dims, sumsq),
+            ),
+            coords=coords,
+        )
+
+    if not grouped:
+        sums = sums.isel({key.name: 0}, drop=True)
+    return sums
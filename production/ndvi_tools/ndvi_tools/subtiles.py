@@ -0,0 +1,158 @@
+"""
+Splitting of heavy tiles into sub-tiles.
+
+A tile whose estimated read volume exceeds a threshold is reduced one
+sub-tile window at a time, so fewer chunks are in memory at once. Windows
+are slices of the lazy full-tile input made of whole chunks, which means
+the halo needed by ``mask_cleanup`` is still pulled in by its overlapping
+Dask graph and edges are identical to an unsplit run. That halo comes from
+the neighbouring chunks, which are read in full: every window also reads
+the ring of chunks around it, and chunks along window edges are read once
+for each window they border. The memory estimate of a window includes
+that ring, so splitting only pays off with chunks well below the tile size.
+"""
+import math
+from functools import partial
+from itertools import product
+from typing import Callable, Dict, List, Optional, Tuple
+
+import dask
+import dask.array as da
+import xarray as xr
+
+# Rough bytes read per output pixel for one dataset of each product:
+# bands loaded x bytes per pixel x native pixels per 30m output pixel
+PRODUCT_READ_BYTES = {
+    "ls5_sr": 5 * 2,  # red, nir, green, blue, QA_PIXEL at 30m
+    "ls7_sr": 5 * 2,
+    "ls8_sr": 5 * 2,
+    "ls9_sr": 5 * 2,
+    "s2_l2a": 9 * 2 + 2.25 * 2 + 2.25,  # red at 10m, nir_2 and SCL at 20m
+}
+DEFAULT_READ_BYTES = 5 * 2
+
+# the plugins' default work_chunks along (y, x)
+DEFAULT_CHUNKS = (1600, 1600)
+
+# most windows along an axis, finer splits only add overhead
+MAX_WINDOWS = 64
+
+
+def estimate_read_bytes(datasets: Dict[str, int], pixels: int) -> int:
+    """
+    Estimate bytes read for ``datasets`` (count per product) over ``pixels``
+    output pixels.
+    """
+    return int(
+        sum(
+            n * PRODUCT_READ_BYTES.get(product, DEFAULT_READ_BYTES) * pixels
+            for product, n in datasets.items()
+        )
+    )
+
+
+def _split_axis(size: int, n: int, align: int = 1) -> List[slice]:
+    # window size rounded up to a whole number of chunks
+    step = math.ceil(math.ceil(size / n) / align) * align
+    return [slice(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def _footprint(windows: List[slice], size: int, halo: int) -> int:
+    # widest window together with the chunks its halo is read from
+    return max(min(w.stop + halo, size) - max(w.start - halo, 0) for w in windows)
+
+
+def _axis_layouts(size: int, align: int, halo: int) -> Dict[int, int]:
+    # footprint of every number of windows _split_axis can produce
+    layouts = {}
+    for n in range(1, min(math.ceil(size / align), MAX_WINDOWS) + 1):
+        windows = _split_axis(size, n, align)
+        layouts.setdefault(len(windows), _footprint(windows, size, halo))
+    return layouts
+
+
+def subtile_shape(
+    read_bytes: int,
+    max_read_bytes: Optional[float] = None,
+    shape: Tuple[int, int] = (1, 1),
+    chunks: Optional[Tuple[int, int]] = None,
+) -> Tuple[int, int]:
+    """
+    Number of windows along (y, x) of a tile of ``shape`` pixels loaded in
+    ``chunks``, so each reads at most ``max_read_bytes`` including the
+    chunks around it. If no split gets there, the one reading the least,
+    or ``(1, 1)`` if splitting doesn't read less than the whole tile. In
+    memory data (no ``chunks``) has no halo to read.
+    """
+    if max_read_bytes is None or read_bytes <= max_read_bytes:
+        return (1, 1)
+
+    per_pixel = read_bytes / (shape[0] * shape[1])
+    align, halo = (chunks, chunks) if chunks else ((1, 1), (0, 0))
+    ys, xs = (_axis_layouts(*axis) for axis in zip(shape, align, halo))
+
+    def cost(n):
+        ny, nx = n
+        return (ys[ny] * xs[nx] * per_pixel, ny * nx, abs(ny - nx))
+
+    layouts = sorted(product(ys, xs), key=cost)
+    fits = [n for n in layouts if cost(n)[0] <= max_read_bytes]
+    if fits:
+        return min(fits, key=lambda n: cost(n)[1:])
+    return layouts[0]
+
+
+def _compute_window(window: xr.Dataset, previous=None) -> xr.Dataset:
+    # ``previous`` is the window before, only there to order the windows
+    try:
+        from distributed import get_worker, worker_client
+
+        get_worker()
+    except (ImportError, ValueError):
+        return window.compute()
+
+    # leave this worker's slot to the tasks of the window
+    with worker_client() as client:
+        return client.compute(window).result()
+
+
+def reduce_by_subtile(
+    reduce: Callable[[xr.Dataset], xr.Dataset],
+    xx: xr.Dataset,
+    shape: Tuple[int, int],
+    chunks: Optional[Dict[str, int]] = None,
+) -> xr.Dataset:
+    """
+    Apply ``reduce`` to ``shape`` windows of ``xx`` and stitch the pieces
+    back into the full tile.
+
+    Windows are aligned to ``chunks``. For Dask data the result stays lazy:
+    each window is computed by one task, which waits for the task of the
+    window before it, so windows run one after the other when the result
+    is computed. Chunks bordering a window are read by it for the halo too,
+    see the module docstring.
+    """
+    chunks = chunks or {}
+    ys = _split_axis(xx.sizes["y"], shape[0], chunks.get("y", 1))
+    xs = _split_axis(xx.sizes["x"], shape[1], chunks.get("x", 1))
+
+    previous = None
+    rows = []
+    for y in ys:
+        row = []
+        for x in xs:
+            window = reduce(xx.isel(y=y, x=x))
+            if not dask.is_dask_collection(window):
+                row.append(window)
+                continue
+
+            done = dask.delayed(partial(_compute_window, window))(previous)
+            data = {
+                name: da.from_delayed(done[name].data, band.shape, dtype=band.dtype)
+                for name, band in window.data_vars.items()
+            }
+            row.append(window.copy(data=data))
+            previous = done
+        rows.append(row)
+
+    return xr.combine_nested(rows, concat_dim=["y", "x"], combine_attrs="override")
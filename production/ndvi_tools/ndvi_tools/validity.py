@@ -0,0 +1,86 @@
+"""
+Clear observation counts and re-masking without a boolean time stack.
+
+The NDVI time series marks missing observations with NaN. Rather than
+materialising ``isnan`` over the whole (time, y, x) stack and keeping it
+around for the counts and for re-masking the smoothed series, both walk
+the time slices of every block: the counts go into a per-pixel ``int16``
+counter and re-masking reads the NaNs of the original NDVI directly.
+"""
+from functools import partial
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+
+def _count(x: np.ndarray, axis, keepdims: bool = False) -> np.ndarray:
+    if isinstance(axis, tuple):
+        (axis,) = axis
+
+    counter = np.zeros(x.shape[:axis] + x.shape[axis + 1 :], dtype=np.int16)
+    index = [slice(None)] * x.ndim
+    for i in range(x.shape[axis]):
+        index[axis] = i
+        xt = x[tuple(index)]
+        counter += xt == xt  # not NaN
+
+    if keepdims:
+        counter = np.expand_dims(counter, axis)
+    return counter
+
+
+def _total(x: np.ndarray, axis, keepdims: bool = False) -> np.ndarray:
+    return x.sum(axis=axis, keepdims=keepdims, dtype=np.int16)
+
+
+def clear_count(ndvi: xr.DataArray, dim: str = "spec") -> xr.DataArray:
+    """
+    Number of observations along ``dim`` that aren't NaN, as ``int16``.
+    """
+    axis = ndvi.get_axis_num(dim)
+    if dask.is_dask_collection(ndvi.data):
+        data = da.reduction(ndvi.data, _count, _total, axis=axis, dtype=np.int16)
+    else:
+        data = _count(ndvi.data, axis)
+
+    dims = tuple(d for d in ndvi.dims if d != dim)
+    coords = {k: v for k, v in ndvi.coords.items() if dim not in v.dims}
+    return xr.DataArray(data, dims=dims, coords=coords, name="clear_count")
+
+
+def _remask(
+    smooth: np.ndarray, ndvi: np.ndarray, axis: int, copy: bool = False
+) -> np.ndarray:
+    if copy:
+        smooth = smooth.copy()
+
+    index = [slice(None)] * smooth.ndim
+    for i in range(smooth.shape[axis]):
+        index[axis] = i
+        xt = ndvi[tuple(index)]
+        smooth[tuple(index)][xt != xt] = np.nan
+    return smooth
+
+
+def remask(smooth: xr.DataArray, ndvi: xr.DataArray, dim: str = "spec") -> xr.DataArray:
+    """
+    ``smooth``, e.g. the rolling mean of ``ndvi``, set to NaN wherever
+    ``ndvi`` is, so smoothing doesn't change the number of observations.
+    In memory ``smooth`` is updated in place.
+    """
+    axis = smooth.get_axis_num(dim)
+    ndvi = ndvi.transpose(*smooth.dims)
+    if dask.is_dask_collection(smooth.data):
+        ndvi = ndvi.chunk(dict(zip(smooth.dims, smooth.chunks)))
+        data = da.map_blocks(
+            partial(_remask, axis=axis, copy=True),
+            smooth.data,
+            ndvi.data,
+            dtype=smooth.dtype,
+        )
+        return smooth.copy(data=data)
+
+    _remask(smooth.data, np.asarray(ndvi.data), axis)
+    return smooth
@@ -22,6 +22,7 @@ REQUIRED = [
     "xarray",
     "fsspec",
     "pandas",
+    "zarr",
 ]
 
 # Package meta-data.
@@ -55,7 +56,13 @@ setup_kwargs = {
     "include_package_data": True,
     "license": "Apache License 2.0",
     "entry_points": {
-        "console_scripts": ["ndvi-task = ndvi_tools.geojson_defined_tasks:main"]
+        "console_scripts": [
+            "ndvi-task = ndvi_tools.geojson_defined_tasks:main",
+            "ndvi-mosaic = ndvi_tools.mosaic:main",
+        ],
+        "datacube.plugins.io.read": [
+            "ndvi_tools.reader = ndvi_tools.reader:rdr_driver_init"
+        ],
     },
 }
 
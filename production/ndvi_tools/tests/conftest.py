@@ -0,0 +1,62 @@
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from ndvi_tools import ndvi_anomaly_plugin, ndvi_climatology_plugin
+
+from .perf.golden import golden_climatology, golden_load, golden_wofs
+
+
+@pytest.fixture
+def make_ndvi():
+    """
+    Factory of synthetic NDVI time series: ``periods`` observations every
+    ``freq`` from 2001-01-03 on ``shape`` (y, x) 30m pixels, random values
+    in [0, 1) and about ``missing`` of them NaN.
+    """
+
+    def make(periods=60, shape=(6, 5), freq="9D", missing=0.3, dtype="float32"):
+        rng = np.random.default_rng(0)
+        time = pd.date_range("2001-01-03", periods=periods, freq=freq)
+        data = rng.random((periods,) + tuple(shape)).astype(dtype)
+        data[rng.random(data.shape) > 1 - missing] = np.nan
+        return xr.DataArray(
+            data,
+            dims=("spec", "y", "x"),
+            coords={
+                "spec": time,
+                "time": ("spec", time),
+                "y": -30 * np.arange(shape[0]) - 15.0,
+                "x": 30 * np.arange(shape[1]) + 15.0,
+            },
+        )
+
+    return make
+
+
+@pytest.fixture
+def done():
+    """
+    Wraps a result in a finished ``Future``, as prefetched ancillaries are.
+    """
+
+    def wrap(result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    return wrap
+
+
+@pytest.fixture
+def standins(monkeypatch):
+    """
+    Plugins read the golden tiles and ancillaries instead of the datacube.
+    """
+    for module in (ndvi_anomaly_plugin, ndvi_climatology_plugin):
+        monkeypatch.setattr(module, "load_with_native_transform", golden_load)
+        monkeypatch.setattr(module, "load_wofs_mask", golden_wofs)
+    monkeypatch.setattr(ndvi_anomaly_plugin, "load_climatology", golden_climatology)
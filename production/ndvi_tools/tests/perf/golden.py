@@ -0,0 +1,283 @@
+"""
+Golden tiles for the performance harness.
+
+A golden tile is a small geobox plus a deterministic list of datasets built
+from the product definitions in ``tests/data/test.db``, standing in for the
+dataset cache. ``golden_load`` stands in for ``load_with_native_transform``
+and the ``dc.load`` behind it: it synthesises the raw bands of every
+dataset on the output geobox, seeded by the dataset id, with clouds, hazy
+pixels and nodata edges, so the plugins' masking, fusing and reductions
+run unchanged. The climatology and WOfS ancillaries are synthesised too.
+"""
+import copy
+import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+import xarray as xr
+from datacube.model import Dataset
+from datacube.utils.dates import normalise_dt
+from datacube.utils.geometry import GeoBox, assign_crs
+from odc.algo._grouper import solar_offset
+from odc.dscache import DatasetCache
+from odc.dscache.tools.tiling import GRIDS
+
+TEST_DB = Path(__file__).parent.parent / "data" / "test.db"
+
+# the test.db tile, golden geoboxes are its top left corner
+TILE = (170, 85)
+SHAPE = (48, 48)
+
+# Landsat QA_PIXEL: clear with low confidences, high confidence cloud, nodata
+QA_CLEAR = 21824
+QA_CLOUD = 22280
+QA_NODATA = 1
+
+# Sentinel-2 SCL classes
+SCL_VEGETATION = 4
+SCL_CLOUD = 9
+SCL_NODATA = 0
+
+LANDSAT_SCALE, LANDSAT_OFFSET = 0.0000275, -0.2
+
+
+class GoldenTile(NamedTuple):
+    datasets: List[Dataset]
+    geobox: GeoBox
+
+
+@lru_cache()
+def _templates() -> Dict[str, Dataset]:
+    cache = DatasetCache.open_ro(str(TEST_DB))
+    templates: Dict[str, Dataset] = {}
+    for ds in cache.get_all():
+        templates.setdefault(ds.type.name, ds)
+        if len(templates) == len(cache.products):
+            break
+    return templates
+
+
+def golden_dataset(product: str, time: datetime, scene: int = 0) -> Dataset:
+    """
+    A ``product`` dataset acquired at ``time``, ``scene`` tells apart
+    overlapping scenes of the same pass.
+    """
+    template = _templates()[product]
+    doc = copy.deepcopy(template.metadata_doc)
+    doc["id"] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{product}/{time}/{scene}"))
+    doc["properties"]["datetime"] = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    return Dataset(template.type, doc, uris=template.uris)
+
+
+def _passes(
+    product: str, start: datetime, end: datetime, every: int, scenes: int
+) -> List[Dataset]:
+    datasets = []
+    time = start
+    while time < end:
+        for scene in range(scenes):
+            datasets.append(
+                golden_dataset(product, time + timedelta(seconds=10 * scene), scene)
+            )
+        time += timedelta(days=every)
+    return datasets
+
+
+def golden_geobox() -> GeoBox:
+    return GRIDS["africa_30"].tile_geobox(TILE)[: SHAPE[0], : SHAPE[1]]
+
+
+def anomaly_tile() -> GoldenTile:
+    """
+    One month of Landsat 8 and Sentinel-2, Sentinel-2 passes are made of two
+    overlapping scenes that get fused.
+    """
+    start, end = datetime(2021, 8, 1, 10, 58), datetime(2021, 9, 1)
+    datasets = _passes("ls8_sr", start, end, every=16, scenes=1) + _passes(
+        "s2_l2a", start + timedelta(days=2, minutes=12), end, every=5, scenes=2
+    )
+    return GoldenTile(datasets, golden_geobox())
+
+
+def climatology_tile() -> GoldenTile:
+    """
+    Two years of Landsat 8, every other pass made of two overlapping scenes.
+    """
+    datasets = []
+    for year in (2019, 2020):
+        start = datetime(year, 1, 3, 10, 58)
+        datasets += _passes("ls8_sr", start, datetime(year, 12, 31), 32, scenes=2)
+        datasets += _passes(
+            "ls8_sr", start + timedelta(days=16), datetime(year, 12, 31), 32, 1
+        )
+    return GoldenTile(datasets, golden_geobox())
+
+
+def _coords(geobox: GeoBox) -> Dict[str, Any]:
+    return geobox.xr_coords(with_crs=True)
+
+
+def _vegetation(geobox: GeoBox, time: datetime) -> np.ndarray:
+    # the same smooth NDVI field for every dataset, with a seasonal cycle
+    y, x = np.mgrid[: geobox.shape[0], : geobox.shape[1]] / max(geobox.shape)
+    season = np.sin(2 * np.pi * time.timetuple().tm_yday / 365.25)
+    return 0.45 + 0.2 * np.sin(3 * x) * np.cos(2 * y) + 0.1 * season
+
+
+def _blobs(rng: np.random.Generator, shape, fraction: float) -> np.ndarray:
+    # blocky patches of 8 pixels covering about ``fraction`` of the geobox
+    coarse = rng.random((shape[0] // 8 + 1, shape[1] // 8 + 1)) < fraction
+    return np.kron(coarse, np.ones((8, 8), dtype=bool))[: shape[0], : shape[1]]
+
+
+def golden_bands(
+    ds: Dataset, bands: Sequence[str], geobox: GeoBox
+) -> Dict[str, xr.DataArray]:
+    """
+    Raw ``bands`` of ``ds`` on ``geobox``, deterministic per dataset.
+    """
+    rng = np.random.default_rng(uuid.UUID(str(ds.id)).int % 2**32)
+    time = normalise_dt(ds.center_time)
+    shape = geobox.shape
+
+    ndvi = _vegetation(geobox, time) + rng.normal(0, 0.03, shape)
+    red = rng.uniform(0.03, 0.09, shape)
+    nir = red * (1 + ndvi) / (1 - ndvi)
+    cloud = _blobs(rng, shape, 0.2)
+    haze = _blobs(rng, shape, 0.05) & ~cloud
+    nodata = np.zeros(shape, dtype=bool)
+    edge = rng.integers(0, shape[1] // 2)
+    if int(ds.metadata_doc["id"][-1], 16) % 2:
+        nodata[:, :edge] = True
+    else:
+        nodata[:, shape[1] - edge :] = True
+
+    if ds.type.name == "s2_l2a":
+        values = dict(
+            red=red * 10000,
+            nir_2=nir * 10000,
+            SCL=np.where(cloud, SCL_CLOUD, SCL_VEGETATION),
+        )
+        values["SCL"][nodata] = SCL_NODATA
+    else:
+        blue = np.where(haze, 0.4, red * 0.8)
+        values = {
+            name: (refl - LANDSAT_OFFSET) / LANDSAT_SCALE
+            for name, refl in dict(red=red, nir=nir, green=red, blue=blue).items()
+        }
+        values["QA_PIXEL"] = np.where(cloud, QA_CLOUD, QA_CLEAR)
+        values["QA_PIXEL"][nodata] = QA_NODATA
+
+    measurements = ds.type.lookup_measurements(bands)
+    out = {}
+    for name, m in measurements.items():
+        data = values[name]
+        if name not in ("QA_PIXEL", "SCL"):
+            data = np.where(nodata, m.nodata, np.clip(data, 1, 65000))
+        attrs = dict(nodata=m.nodata, units=m.get("units", "1"))
+        if "flags_definition" in m:
+            attrs["flags_definition"] = m.flags_definition
+        out[name] = xr.DataArray(
+            data.astype(m.dtype), dims=("y", "x"), coords=_coords(geobox), attrs=attrs
+        )
+
+    return out
+
+
+def golden_load(
+    dss: Sequence[Dataset],
+    bands: Sequence[str],
+    geobox: GeoBox,
+    native_transform,
+    groupby: Optional[str] = None,
+    fuser=None,
+    resampling: str = "nearest",
+    chunks: Optional[Dict[str, int]] = None,
+    **kw,
+) -> xr.Dataset:
+    """
+    Stand-in for ``load_with_native_transform``.
+    """
+    if len(dss) == 0:
+        # odc-algo fails the same way, the climatology relies on it
+        raise ValueError("No datasets to load")
+
+    dss = sorted(dss, key=lambda ds: (normalise_dt(ds.center_time), str(ds.id)))
+    offset = solar_offset(geobox.extent)
+    time = [normalise_dt(ds.center_time) for ds in dss]
+    solar_day = np.asarray([(t + offset).date() for t in time], dtype="datetime64[D]")
+    time = np.asarray(time, dtype="datetime64[ns]")
+
+    slices = [golden_bands(ds, bands, geobox) for ds in dss]
+    xx = xr.Dataset(
+        {name: xr.concat([s[name] for s in slices], dim="spec") for name in slices[0]}
+    )
+    xx = assign_crs(xx.assign_coords(spec=time), str(geobox.crs))
+    if chunks is not None:
+        xx = xx.chunk(dict(spec=1, **chunks))
+
+    xx = native_transform(xx)
+    if groupby is not None:
+        # fuse observations of the same solar day
+        xx = xr.concat(
+            [
+                fuser(xx.isel(spec=np.flatnonzero(solar_day == day)))
+                for day in np.unique(solar_day)
+            ],
+            dim="spec",
+        )
+
+    return xx.assign_coords(time=("spec", xx.spec.values))
+
+
+def golden_climatology(
+    geobox: GeoBox,
+    month: str,
+    min_num_obs: int,
+    resampling: str = "bilinear",
+    dask_chunks: Optional[Dict[str, Any]] = None,
+) -> xr.Dataset:
+    """
+    Stand-in for ``load_climatology``.
+    """
+    rng = np.random.default_rng(1)
+    mean = _vegetation(geobox, datetime(2021, 8, 15)) + rng.normal(
+        0, 0.02, geobox.shape
+    )
+    std = rng.uniform(0.02, 0.1, geobox.shape)
+    count = rng.integers(0, 60, geobox.shape)
+
+    clim = xr.Dataset(
+        {
+            f"mean_{month}": (("y", "x"), mean.astype(np.float32)),
+            f"stddev_{month}": (("y", "x"), std.astype(np.float32)),
+            f"count_{month}": (("y", "x"), count.astype(np.int16)),
+        },
+        coords=_coords(geobox),
+    )
+    clim = clim.where(clim[f"count_{month}"] >= min_num_obs)
+    if dask_chunks is not None:
+        clim = clim.chunk(dask_chunks)
+    return clim
+
+
+def golden_wofs(
+    geobox: GeoBox,
+    wofs_threshold: float,
+    dask_chunks: Optional[Dict[str, Any]] = None,
+) -> xr.DataArray:
+    """
+    Stand-in for ``load_wofs_mask``, a lake in the middle of the geobox.
+    """
+    y, x = np.mgrid[: geobox.shape[0], : geobox.shape[1]]
+    cy, cx = geobox.shape[0] / 2, geobox.shape[1] / 2
+    frequency = np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / 40)
+
+    wofs = xr.DataArray(frequency, dims=("y", "x"), coords=_coords(geobox))
+    wofs = wofs < wofs_threshold
+    if dask_chunks is not None:
+        wofs = wofs.chunk(dask_chunks)
+    return wofs
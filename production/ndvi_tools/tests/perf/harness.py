@@ -0,0 +1,230 @@
+"""
+Measure golden tile runs and check them against committed references and
+budgets.
+
+Every case runs ``input_data`` and ``reduce`` end to end with Dask's
+synchronous scheduler: once to warm up, so imports and compilation aren't
+measured, once under ``tracemalloc`` for the peak memory and, only if
+``NDVI_PERF_WALL_TIME=1``, once untraced for the wall time, which is too
+noisy on shared CI runners to check by default. The Dask task count is
+taken from the graph ``reduce`` returns. Outputs of both engines are
+compared with the one reference of their plugin, ``references/<plugin>.npz``,
+and the measurements with ``budgets.json``, which also holds how far above
+its budget each metric may go.
+
+Budgets are relative to the run itself, so they hold whatever machine and
+package versions the tests run with: Dask tasks per chunk and peak memory
+per byte of what ``input_data`` loaded, and wall time in units of a fixed
+NumPy workload timed alongside. Set ``NDVI_PERF_UPDATE=1`` to record new
+references (from the Dask engine) and budgets instead, e.g. after an
+intended change, and commit them with it.
+"""
+import json
+import math
+import os
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import dask
+import numpy as np
+import xarray as xr
+
+HERE = Path(__file__).parent
+BUDGETS = HERE / "budgets.json"
+REFERENCES = HERE / "references"
+UPDATE_ENV = "NDVI_PERF_UPDATE"
+WALL_TIME_ENV = "NDVI_PERF_WALL_TIME"
+
+METRICS = ("wall_time", "tasks_per_chunk", "memory_per_byte")
+
+
+class Measurement(NamedTuple):
+    # wall time in units of ``calibration_time``
+    wall_time: Optional[float]
+    # Dask tasks and peak memory per chunk and byte of the loaded input
+    tasks_per_chunk: float
+    memory_per_byte: float
+
+
+def _enabled(name: str) -> bool:
+    return os.environ.get(name, "") not in ("", "0")
+
+
+def updating() -> bool:
+    return _enabled(UPDATE_ENV)
+
+
+def timing() -> bool:
+    return updating() or _enabled(WALL_TIME_ENV)
+
+
+def checked_metrics() -> Tuple[str, ...]:
+    return METRICS if timing() else METRICS[1:]
+
+
+def calibration_time() -> float:
+    """
+    Seconds a fixed NumPy workload takes here, the best of a few runs, the
+    unit of the measured wall times.
+    """
+    data = np.random.default_rng(0).random(2**21)
+    best = math.inf
+    for _ in range(5):
+        t0 = time.perf_counter()
+        np.sort(data)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _chunks(xx: xr.Dataset) -> int:
+    return sum(
+        band.data.npartitions if dask.is_dask_collection(band.data) else 1
+        for band in xx.data_vars.values()
+    )
+
+
+def _run(plugin, datasets, geobox) -> Tuple[xr.Dataset, int, Tuple[int, int]]:
+    with dask.config.set(scheduler="synchronous"):
+        xx = plugin.input_data(datasets, geobox)
+        loaded = (xx.nbytes, _chunks(xx))
+        out = plugin.reduce(xx)
+        tasks = len(out.__dask_graph__()) if dask.is_dask_collection(out) else 0
+        return out.compute(), tasks, loaded
+
+
+def measure(plugin, datasets, geobox) -> Tuple[xr.Dataset, Measurement]:
+    """
+    Output of ``plugin`` for a golden tile and what it took to compute it,
+    the wall time only if ``timing``.
+    """
+    out, tasks, (nbytes, chunks) = _run(plugin, datasets, geobox)
+
+    tracemalloc.start()
+    try:
+        _run(plugin, datasets, geobox)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    wall_time = None
+    if timing():
+        t0 = time.perf_counter()
+        _run(plugin, datasets, geobox)
+        wall_time = (time.perf_counter() - t0) / calibration_time()
+
+    return out, Measurement(wall_time, tasks / chunks, peak / nbytes)
+
+
+def _load_budgets() -> Dict:
+    if not BUDGETS.exists():
+        return dict(tolerances={}, cases={})
+    return json.loads(BUDGETS.read_text())
+
+
+def budget_report(
+    case: str,
+    budget: Dict[str, float],
+    tolerances: Dict[str, float],
+    m: Measurement,
+    metrics: Sequence[str] = METRICS,
+) -> Tuple[List[str], str]:
+    """
+    Names of the ``metrics`` over budget and a table of them.
+    """
+    lines = [
+        f"Performance budget of {case}:",
+        f"  {'metric':<16}{'budget':>10}{'limit':>10}{'measured':>10}{'change':>9}",
+    ]
+    failed = []
+    for metric in metrics:
+        value, allowed = getattr(m, metric), budget[metric]
+        limit = allowed * (1 + tolerances[metric])
+        change = f"{value / allowed - 1:+.0%}" if allowed else "n/a"
+        verdict = ""
+        if value > limit:
+            failed.append(metric)
+            verdict = "  OVER"
+        lines.append(
+            f"  {metric:<16}{allowed:>10.4g}{limit:>10.4g}{value:>10.4g}"
+            f"{change:>9}{verdict}"
+        )
+
+    lines.append(f"Record new budgets with {UPDATE_ENV}=1 if the change is intended.")
+    return failed, "\n".join(lines)
+
+
+def check_budget(case: str, m: Measurement) -> Tuple[List[str], str]:
+    """
+    Metrics of ``case`` over budget and the report, records ``m`` as the new
+    budget when updating.
+    """
+    budgets = _load_budgets()
+    if updating():
+        budgets["cases"][case] = {
+            metric: round(getattr(m, metric), 3) for metric in METRICS
+        }
+        BUDGETS.write_text(json.dumps(budgets, indent=2, sort_keys=True) + "\n")
+        return [], ""
+
+    if case not in budgets["cases"]:
+        return ["missing"], f"No budget for {case}, record one with {UPDATE_ENV}=1"
+
+    return budget_report(
+        case, budgets["cases"][case], budgets["tolerances"], m, checked_metrics()
+    )
+
+
+def check_reference(
+    reference: str,
+    out: xr.Dataset,
+    record: bool = True,
+    rtol: float = 1e-5,
+    atol: float = 1e-5,
+) -> List[str]:
+    """
+    Differences between ``out`` and ``reference``, records ``out`` as the
+    reference when updating and ``record``. The default tolerances allow
+    for float round-off of other NumPy and xarray versions than the one
+    the reference was recorded with.
+    """
+    path = REFERENCES / f"{reference}.npz"
+    if updating() and record:
+        REFERENCES.mkdir(exist_ok=True)
+        np.savez_compressed(path, **{k: v.values for k, v in out.data_vars.items()})
+        return []
+
+    if not path.exists():
+        return [f"No reference {reference}, record one with {UPDATE_ENV}=1"]
+
+    diffs = []
+    with np.load(path) as reference:
+        missing = set(reference.files) ^ set(out.data_vars)
+        if missing:
+            diffs.append(f"bands differ from the reference: {sorted(missing)}")
+
+        for band in sorted(set(reference.files) & set(out.data_vars)):
+            expected, actual = reference[band], out[band].values
+            if expected.shape != actual.shape or expected.dtype != actual.dtype:
+                diffs.append(
+                    f"{band}: {actual.dtype}{list(actual.shape)}, reference is "
+                    f"{expected.dtype}{list(expected.shape)}"
+                )
+                continue
+
+            if np.issubdtype(expected.dtype, np.floating):
+                close = np.isclose(
+                    actual, expected, rtol=rtol, atol=atol, equal_nan=True
+                )
+            else:
+                close = actual == expected
+            if not close.all():
+                error = np.abs(actual.astype(np.float64) - expected)[~close]
+                diffs.append(
+                    f"{band}: {(~close).sum()} of {close.size} pixels differ, "
+                    f"max abs. difference {np.nanmax(error, initial=0):.3g}, "
+                    f"{int(np.isnan(error).sum())} where only one is NaN"
+                )
+
+    return diffs
@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import dask
+import pytest
+import yaml
+
+from ndvi_tools.ndvi_anomaly_plugin import NDVIAnomaly
+from ndvi_tools.ndvi_climatology_plugin import NDVIClimatology
+
+from . import harness
+from .golden import anomaly_tile, climatology_tile
+from .harness import (
+    Measurement,
+    budget_report,
+    check_budget,
+    check_reference,
+    measure,
+)
+
+CONFIG = Path(__file__).parents[2] / "config"
+
+# small blocks so the Dask cases have blocks and block edges to deal with
+WORK_CHUNKS = dict(x=24, y=24)
+
+CASES = {
+    "anomaly-numpy": (NDVIAnomaly, "ndvi_anomaly.yaml", anomaly_tile, "numpy"),
+    "anomaly-dask": (NDVIAnomaly, "ndvi_anomaly.yaml", anomaly_tile, "dask"),
+    "climatology-numpy": (
+        NDVIClimatology,
+        "ndvi_climatology.yaml",
+        climatology_tile,
+        "numpy",
+    ),
+    "climatology-dask": (
+        NDVIClimatology,
+        "ndvi_climatology.yaml",
+        climatology_tile,
+        "dask",
+    ),
+}
+
+
+def _configured(case):
+    plugin, config, tile, engine = CASES[case]
+    config = yaml.safe_load((CONFIG / config).read_text())["plugin_config"]
+    return plugin(**config, engine=engine, work_chunks=WORK_CHUNKS), tile
+
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_golden_tile(case, standins):
+    plugin, tile = _configured(case)
+    reference, engine = case.split("-")
+
+    # both engines agree exactly and are held to one reference, recorded
+    # from the Dask run
+    out, measurement = measure(plugin, *tile())
+    diffs = check_reference(reference, out, record=engine == "dask")
+    if diffs:
+        header = f"Outputs of {case} differ from the {reference} reference:"
+        pytest.fail("\n  ".join([header] + diffs), pytrace=False)
+
+    failed, report = check_budget(case, measurement)
+    if failed:
+        pytest.fail(report, pytrace=False)
+
+
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_ancillaries_are_prefetched(case, standins):
+    plugin, tile = _configured(case)
+    in_memory = case.endswith("numpy")
+
+    xx = plugin.input_data(*tile())
+    # Dask tiles only look them up, their reads are part of the graph
+    _, prefetched = plugin._prefetched
+    if not isinstance(prefetched, dict):
+        prefetched = dict(wofs=prefetched)
+    for future in prefetched.values():
+        assert dask.is_dask_collection(future.result()) != in_memory
+    out = plugin.reduce(xx)
+    assert plugin._prefetched is None
+    assert dask.is_dask_collection(out) != in_memory
+
+
+def test_budget_report():
+    budget = dict(wall_time=1.0, tasks_per_chunk=100, memory_per_byte=10.0)
+    tolerances = dict(wall_time=1.0, tasks_per_chunk=0.1, memory_per_byte=0.25)
+
+    failed, report = budget_report(
+        "case", budget, tolerances, Measurement(1.5, 120, 10.0)
+    )
+    assert failed == ["tasks_per_chunk"]
+    lines = report.splitlines()
+    assert lines[2].split()[:4] == ["wall_time", "1", "2", "1.5"]
+    assert lines[3].split()[-2:] == ["+20%", "OVER"]
+    assert not lines[4].endswith("OVER")
+
+
+def test_wall_time_is_opt_in(monkeypatch):
+    monkeypatch.delenv(harness.UPDATE_ENV, raising=False)
+    monkeypatch.delenv(harness.WALL_TIME_ENV, raising=False)
+    assert "wall_time" not in harness.checked_metrics()
+
+    monkeypatch.setenv(harness.WALL_TIME_ENV, "1")
+    assert "wall_time" in harness.checked_metrics()
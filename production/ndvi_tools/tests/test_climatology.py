@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import xarray as xr
+from datacube.utils.geometry import assign_crs
+
+from ndvi_tools.ancillary import MONTHS
+from ndvi_tools.ndvi_climatology_plugin import NDVIClimatology
+
+
+def _baseline(ndvi, wofs, rolling_window):
+    # the per-month loop reduce had before the stacked layout, without I/O,
+    # accumulated in float64 like the smoothing kernels
+    ndvi = ndvi.astype(np.float64)
+    clear = ndvi.notnull()
+    counts = clear.groupby(clear.spec["time.month"]).sum("spec")
+    ndvi = ndvi.rolling(spec=rolling_window, min_periods=1).mean().where(clear)
+    mean = ndvi.groupby(ndvi.spec["time.month"]).mean("spec")
+    std = ndvi.groupby(ndvi.spec["time.month"]).std("spec")
+
+    bands = {}
+    for stat, xx, dtype in (
+        ("mean", mean, np.float32),
+        ("stddev", std, np.float32),
+        ("count", counts, np.int16),
+    ):
+        for m, month in enumerate(MONTHS, start=1):
+            bands[f"{stat}_{month}"] = xx.sel(month=m, drop=True).astype(dtype)
+
+    return xr.Dataset(bands).where(wofs)
+
+
+@pytest.mark.parametrize("chunks", [None, dict(y=3, x=3)])
+def test_reduce_matches_baseline_bands(make_ndvi, done, chunks):
+    ndvi = assign_crs(make_ndvi(), "epsg:6933")
+    rng = np.random.default_rng(1)
+    wofs = xr.DataArray(
+        rng.random((6, 5)) > 0.2, dims=("y", "x"), coords=dict(y=ndvi.y, x=ndvi.x)
+    )
+    expected = _baseline(ndvi, wofs, 3)
+
+    plugin = NDVIClimatology(rolling_window=3, work_chunks=dict(y=3, x=3))
+    xx = ndvi
+    if chunks is not None:
+        # chunked like a load, the time coordinate stays in memory
+        xx = ndvi.chunk(chunks).assign_coords(time=ndvi.time)
+    clim = plugin._reduce(xx.to_dataset(name="ndvi"), wofs=done(wofs)).compute()
+
+    assert list(clim.data_vars) == list(plugin.output_bands)
+    assert list(clim.data_vars) == list(expected.data_vars)
+    for name, band in clim.data_vars.items():
+        if name.startswith("count"):
+            # counts stay integers, with a nodata value over water instead of NaN
+            assert band.dtype == np.int16
+            assert band.attrs["nodata"] == plugin.count_nodata
+            np.testing.assert_array_equal(
+                band, expected[name].fillna(plugin.count_nodata)
+            )
+        else:
+            assert band.dtype == expected[name].dtype == np.float32
+            np.testing.assert_allclose(band, expected[name], rtol=1e-6)
@@ -0,0 +1,163 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+import yaml
+from datacube.utils.geometry import assign_crs
+
+from ndvi_tools.cube import (
+    cube_location,
+    monthly_cube,
+    new_datasets,
+    open_cube,
+    previous_tail,
+    read_cube,
+    update_monthly_cube,
+    write_cube,
+)
+from ndvi_tools.ndvi_anomaly_plugin import NDVIAnomaly
+from ndvi_tools.ndvi_climatology_plugin import NDVIClimatology
+
+from .perf.golden import anomaly_tile, climatology_tile
+
+CONFIG = Path(__file__).parents[1] / "config"
+ROLLING_WINDOW = 3
+
+
+@pytest.fixture
+def ndvi(make_ndvi):
+    return make_ndvi().chunk({"y": 3})
+
+
+def test_monthly_cube_matches_plugin_reduction(ndvi):
+    # the plugins' smoothing and per-month statistics
+    clear = ndvi.notnull()
+    smooth = ndvi.rolling(spec=ROLLING_WINDOW, min_periods=1).mean().where(clear)
+
+    cube = monthly_cube(ndvi, ROLLING_WINDOW)
+    month = cube.time.dt.month
+    n = cube.clear_count.groupby(month).sum("time")
+    mean = cube.ndvi_sum.groupby(month).sum("time") / n
+    std = np.sqrt((cube.ndvi_sumsq.groupby(month).sum("time") / n - mean**2).clip(0))
+
+    np.testing.assert_array_equal(n, clear.groupby("spec.month").sum("spec"))
+    np.testing.assert_allclose(
+        mean, smooth.groupby("spec.month").mean("spec"), rtol=1e-6
+    )
+    np.testing.assert_allclose(std, smooth.groupby("spec.month").std("spec"), atol=1e-6)
+
+
+def test_write_cube_continues_smoothing(ndvi, tmp_path):
+    location = str(tmp_path / "x000y000.zarr")
+    months = ndvi.spec["time"].values.astype("datetime64[M]")
+    split = np.datetime64("2001-08")
+    first = ndvi.isel(spec=np.flatnonzero(months < split))
+    second = ndvi.isel(spec=np.flatnonzero(months >= split))
+
+    write_cube(monthly_cube(first, ROLLING_WINDOW), location)
+    tail = previous_tail(location, split)
+    assert tail is not None
+
+    cube = monthly_cube(second, ROLLING_WINDOW, tail=tail)
+    write_cube(cube, location)
+    # rewriting months already in the store overwrites them in place
+    write_cube(cube, location)
+
+    stored = read_cube(location, months.min(), months.max()).compute()
+    xr.testing.assert_allclose(stored, monthly_cube(ndvi, ROLLING_WINDOW).compute())
+
+
+def test_write_cube_only_appends_later_months(ndvi, tmp_path):
+    location = str(tmp_path / "x000y000.zarr")
+    months = ndvi.spec["time"].values.astype("datetime64[M]")
+    split = np.datetime64("2001-08")
+
+    write_cube(monthly_cube(ndvi[months >= split], ROLLING_WINDOW), location)
+    with pytest.raises(ValueError):
+        write_cube(monthly_cube(ndvi[months < split], ROLLING_WINDOW), location)
+
+
+def test_update_monthly_cube_matches_full_month(ndvi, tmp_path):
+    template = str(tmp_path / "x{x:03d}y{y:03d}.zarr")
+    ndvi = assign_crs(ndvi, "epsg:6933")
+    times = ndvi.spec["time"].values
+    months = times.astype("datetime64[M]")
+
+    # scenes arrive a few at a time, repeats are ignored
+    for month in np.unique(months)[:3]:
+        arrived = np.flatnonzero(months == month)
+        for end in (1, 2, len(arrived), len(arrived)):
+            update = update_monthly_cube(
+                ndvi.isel(spec=arrived[:end]), template, ROLLING_WINDOW
+            )
+            update.compute()
+
+    location = cube_location(template, ndvi.geobox)
+    expected = monthly_cube(ndvi, ROLLING_WINDOW).isel(time=slice(0, 3))
+    xr.testing.assert_allclose(
+        open_cube(location).compute().drop_vars("spatial_ref"),
+        expected.compute().drop_vars("spatial_ref"),
+    )
+
+
+def test_update_mode_folds_late_scenes(standins, tmp_path):
+    config = yaml.safe_load((CONFIG / "ndvi_anomaly.yaml").read_text())
+    config = config["plugin_config"]
+    template = str(tmp_path / "x{x:03d}y{y:03d}.zarr")
+    datasets, geobox = anomaly_tile()
+    datasets = sorted(datasets, key=lambda ds: ds.center_time)
+
+    def run(arrived, **kw):
+        plugin = NDVIAnomaly(**config, **kw)
+        return plugin.reduce(plugin.input_data(arrived, geobox)).compute()
+
+    def update(arrived):
+        return run(arrived, cube_mode="update", cube_location=template)
+
+    # the second scene of the second Sentinel-2 pass, which fills in nodata
+    # of the first one, arrives after later passes
+    late = [ds for ds in datasets if ds.type.name == "s2_l2a"][3]
+    early = [ds for ds in datasets if ds is not late]
+    half = len(early) // 2
+
+    update(early[:half])
+    assert new_datasets(template, early, geobox) == early[half:]
+    provisional = update(early)
+
+    assert new_datasets(template, datasets, geobox) == datasets
+    final = update(datasets)
+    assert new_datasets(template, datasets, geobox) == []
+    xr.testing.assert_identical(update(datasets), final)
+
+    expected = run(datasets)
+    assert (provisional.clear_count != expected.clear_count).any()
+    xr.testing.assert_identical(final.clear_count, expected.clear_count)
+    xr.testing.assert_allclose(final, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "plugin, config, tile",
+    [
+        (NDVIAnomaly, "ndvi_anomaly.yaml", anomaly_tile),
+        (NDVIClimatology, "ndvi_climatology.yaml", climatology_tile),
+    ],
+)
+def test_cube_round_trip(plugin, config, tile, standins, tmp_path):
+    config = yaml.safe_load((CONFIG / config).read_text())["plugin_config"]
+    template = str(tmp_path / "x{x:03d}y{y:03d}.zarr")
+    datasets, geobox = tile()
+
+    def run(**kw):
+        # Dask, so the cube write is part of the graph
+        p = plugin(**config, **kw, engine="dask", work_chunks=dict(x=20, y=20))
+        return p.reduce(p.input_data(datasets, geobox))
+
+    written = run(cube_mode="write", cube_location=template)
+    # reduce only builds the graph, the cube is written when it is computed
+    assert open_cube(cube_location(template, geobox)).ndvi_sum.isnull().all()
+    written = written.compute()
+
+    read = run(cube_mode="read", cube_location=template).compute()
+    xr.testing.assert_identical(read, written)
+    xr.testing.assert_allclose(read, run().compute(), rtol=1e-5, atol=1e-5)
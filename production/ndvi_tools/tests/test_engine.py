@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+import yaml
+from datacube.utils.geometry import assign_crs
+
+from ndvi_tools.cube import monthly_cube
+from ndvi_tools.engine import mask_cleanup_blocks, use_numpy
+from ndvi_tools.ndvi_anomaly_plugin import NDVIAnomaly
+from ndvi_tools.ndvi_climatology_plugin import NDVIClimatology
+
+from .perf.golden import anomaly_tile, climatology_tile
+
+CONFIG = Path(__file__).parents[1] / "config"
+
+
+def test_use_numpy():
+    assert use_numpy("auto", 2**30, 2**30)
+    assert not use_numpy("auto", 2**30 + 1, 2**30)
+    assert use_numpy("numpy", 2**40, 2**30)
+    assert not use_numpy("dask", 1, 2**30)
+
+
+def test_numpy_engine_matches_dask(make_ndvi, done):
+    rng = np.random.default_rng(0)
+    ndvi = make_ndvi()
+    cube = monthly_cube(assign_crs(ndvi, "epsg:6933"), 3).compute()
+    wofs = xr.DataArray(
+        rng.random((6, 5)) > 0.1, dims=("y", "x"), coords={"y": ndvi.y, "x": ndvi.x}
+    )
+
+    plugin = NDVIClimatology(work_chunks=dict(x=3, y=3))
+    in_memory = plugin._reduce_cube(cube, wofs=done(wofs))
+    assert not any(v.chunks for v in in_memory.data_vars.values())
+
+    chunked = plugin._reduce_cube(cube.chunk(dict(x=3, y=3)), wofs=done(wofs))
+    xr.testing.assert_identical(in_memory, chunked.compute())
+
+
+@pytest.mark.parametrize(
+    "plugin, config, tile",
+    [
+        (NDVIAnomaly, "ndvi_anomaly.yaml", anomaly_tile),
+        (NDVIClimatology, "ndvi_climatology.yaml", climatology_tile),
+    ],
+)
+def test_numpy_engine_matches_dask_end_to_end(plugin, config, tile, standins):
+    config = yaml.safe_load((CONFIG / config).read_text())["plugin_config"]
+    # blocks smaller than the golden tile, so the Dask path has block edges
+    out = {}
+    for engine in ("numpy", "dask"):
+        p = plugin(**config, engine=engine, work_chunks=dict(x=20, y=20))
+        out[engine] = p.reduce(p.input_data(*tile())).compute()
+
+    xr.testing.assert_identical(out["numpy"], out["dask"])
+
+
+def test_mask_cleanup_blocks_matches_dask():
+    rng = np.random.default_rng(0)
+    # cloud patches of 8x8 pixels, big enough to survive the opening
+    blobs = np.kron(rng.random((2, 7, 6)) > 0.6, np.ones((1, 8, 8), dtype=bool))
+    mask = xr.DataArray(blobs[:, :50, :45], dims=("spec", "y", "x"))
+    filters = [("opening", 5), ("dilation", 5)]
+    chunks = dict(y=20, x=15)
+
+    chunked = mask_cleanup_blocks(mask.chunk(chunks), filters).compute()
+    in_memory = mask_cleanup_blocks(mask, filters, chunks)
+    xr.testing.assert_equal(in_memory, chunked)
+    # a run over the whole array differs at block edges
+    assert (mask_cleanup_blocks(mask, filters) != chunked).any()
@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+import yaml
+
+from ndvi_tools.fuser import first_valid_or_np, xr_first_valid_or
+from ndvi_tools.ndvi_anomaly_plugin import NDVIAnomaly
+
+from .perf.golden import anomaly_tile
+
+CONFIG = Path(__file__).parents[1] / "config"
+
+
+def first_valid(aa, nodata=0):
+    out = aa[0].copy()
+    for a in aa[1:]:
+        out = np.where(out != nodata, out, a)
+    return out
+
+
+def test_first_valid_or_np(group):
+    red, nir, cloud_mask = (group[band].values for band in group.data_vars)
+    out, out_mask = first_valid_or_np([red, nir], cloud_mask, nodata=0)
+
+    assert out.shape == (2, 1) + red.shape[1:]
+    np.testing.assert_array_equal(out[0, 0], first_valid(red))
+    np.testing.assert_array_equal(out[1, 0], first_valid(nir))
+    np.testing.assert_array_equal(out_mask[0], cloud_mask.any(axis=0))
+
+
+def test_xr_first_valid_or_dask_matches_numpy(group):
+    expected = xr_first_valid_or(group)
+    fused = xr_first_valid_or(group.chunk({"spec": 1, "y": 7, "x": 5}))
+
+    assert fused.cloud_mask.dtype == bool
+    xr.testing.assert_identical(fused.compute(), expected)
+
+
+def test_dask_fused_groups_keep_their_data(group):
+    groups = [group, group.isel(spec=slice(None, None, -1)), group.isel(spec=[1, 0])]
+    expected = xr.concat([xr_first_valid_or(g) for g in groups], "spec")
+    fused = xr.concat([xr_first_valid_or(g.chunk({"spec": 1})) for g in groups], "spec")
+
+    xr.testing.assert_identical(fused.compute(), expected)
+
+
+def test_single_pass_fuser_matches_default(standins):
+    config = yaml.safe_load((CONFIG / "ndvi_anomaly.yaml").read_text())["plugin_config"]
+    out = {}
+    for single_pass in (False, True):
+        plugin = NDVIAnomaly(
+            **config,
+            engine="dask",
+            work_chunks=dict(x=20, y=20),
+            single_pass_fuser=single_pass
+        )
+        out[single_pass] = plugin.reduce(plugin.input_data(*anomaly_tile())).compute()
+
+    xr.testing.assert_identical(out[True], out[False])
+
+
+def test_xr_first_valid_or_mixed_dtypes(group):
+    group["nir"] = group["nir"].astype("float32")
+    with pytest.raises(ValueError):
+        xr_first_valid_or(group)
+
+
+@pytest.fixture
+def group():
+    rng = np.random.default_rng(42)
+    shape = (3, 20, 16)
+    dims = ("spec", "y", "x")
+    return xr.Dataset(
+        {
+            "red": (dims, rng.integers(0, 3, shape).astype("uint16")),
+            "nir": (dims, rng.integers(0, 3, shape).astype("uint16")),
+            "cloud_mask": (dims, rng.random(shape) > 0.7),
+        },
+        coords={"spec": np.arange(shape[0])},
+    )
@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+import xarray as xr
+import yaml
+import zarr
+from click.testing import CliRunner
+from odc.dscache.tools.tiling import GRIDS
+
+from ndvi_tools.geojson_defined_tasks import ALL_TILES
+from ndvi_tools.mosaic import (
+    COUNT_NODATA,
+    MOSAIC_GRID,
+    MOSAIC_TILES,
+    create_mosaic,
+    decimate,
+    level_geobox,
+    main,
+    write_mosaic,
+)
+
+LEVELS = (8, 32)
+BANDS = (("ndvi_mean", np.dtype("float32")), ("clear_count", np.dtype("int16")))
+
+
+def _output(tile, seed=0):
+    rng = np.random.default_rng(seed)
+    coords = GRIDS[MOSAIC_GRID].tile_geobox(tile).xr_coords(with_crs=True)
+    shape = (1, 3200, 3200)
+    dims = ("time", "y", "x")
+    coords = dict(time=[np.datetime64("2022-01-31")], **coords)
+
+    mean = rng.random(shape, dtype=np.float32)
+    mean[0, :100, :100] = np.nan
+    count = rng.integers(0, 30, shape).astype(np.int16)
+    count[0, -8:, -8:] = -999
+    return xr.Dataset(
+        dict(
+            ndvi_mean=xr.DataArray(mean, dims=dims, coords=coords),
+            clear_count=xr.DataArray(
+                count, dims=dims, coords=coords, attrs=dict(nodata=-999)
+            ),
+        )
+    )
+
+
+def _chunk(location, factor, name, tile):
+    n = 3200 // factor
+    row = (MOSAIC_TILES["y"][1] - 1 - tile[1]) * n
+    col = (tile[0] - MOSAIC_TILES["x"][0]) * n
+    return zarr.open_array(location, mode="r", path=f"{factor}/{name}")[
+        row : row + n, col : col + n
+    ]
+
+
+def test_mosaic_covers_all_tiles():
+    (x0, x1), (y0, y1) = MOSAIC_TILES["x"], MOSAIC_TILES["y"]
+    for tile in ALL_TILES:
+        assert x0 <= int(tile[1:4]) < x1
+        assert y0 <= int(tile[5:8]) < y1
+
+
+def test_decimate():
+    ds = _output((160, 50))
+    mean = decimate(ds.ndvi_mean.isel(time=0), 8)
+    assert mean.shape == (400, 400) and mean.dtype == np.float32
+    assert np.isnan(mean.values[:12, :12]).all()
+    assert mean.values[12, 12] == pytest.approx(
+        float(ds.ndvi_mean[0, 96:104, 96:104].mean())
+    )
+
+    count = decimate(ds.clear_count.isel(time=0), 8)
+    assert count.dtype == np.int32
+    assert int(count[-1, -1]) == 0
+    valid = ds.clear_count.where(ds.clear_count != -999, 0)
+    assert int(count.sum()) == int(valid.sum())
+
+
+def test_write_mosaic(tmp_path):
+    location = str(tmp_path / "mosaic.zarr")
+    create_mosaic(location, BANDS, LEVELS)
+    tiles = [(160, 50), (161, 50)]
+
+    for i, tile in enumerate(tiles):
+        ds = _output(tile, seed=i).chunk(dict(x=1600, y=1600))
+        out = write_mosaic(ds, location, LEVELS)
+
+        # nothing is written until the output is computed
+        assert np.isnan(_chunk(location, 8, "ndvi_mean", tile)).all()
+        xr.testing.assert_identical(out.compute(), ds.compute())
+
+        ds = ds.isel(time=0).compute()
+        for factor in LEVELS:
+            for name in ("ndvi_mean", "clear_count"):
+                np.testing.assert_array_equal(
+                    _chunk(location, factor, name, tile),
+                    decimate(ds[name], factor).values,
+                )
+
+    mosaic = zarr.open_group(location, mode="r")
+    assert mosaic["32/clear_count"].shape == level_geobox(32).shape
+    assert mosaic["32/clear_count"].chunks == (100, 100)
+    assert (_chunk(location, 32, "clear_count", (162, 50)) == COUNT_NODATA).all()
+    assert np.isnan(_chunk(location, 32, "ndvi_mean", (160, 51))).all()
+
+
+def test_only_the_last_block_waits_for_the_writes(tmp_path):
+    location = str(tmp_path / "mosaic.zarr")
+    create_mosaic(location, BANDS, LEVELS)
+    tile = (160, 50)
+    ds = _output(tile).chunk(dict(x=1600, y=1600))
+    out = write_mosaic(ds, location, LEVELS)
+
+    out.ndvi_mean.data.blocks[0, 0, 0].compute()
+    assert np.isnan(_chunk(location, 8, "ndvi_mean", tile)).all()
+
+    out.ndvi_mean.data.blocks[0, 1, 1].compute()
+    np.testing.assert_array_equal(
+        _chunk(location, 8, "ndvi_mean", tile),
+        decimate(ds.ndvi_mean.isel(time=0), 8).values,
+    )
+    assert (_chunk(location, 8, "clear_count", tile) == COUNT_NODATA).all()
+
+
+@pytest.mark.parametrize("block", [1600, 200])
+def test_write_mosaic_with_threads(tmp_path, block):
+    location = str(tmp_path / "mosaic.zarr")
+    levels = LEVELS + (128,)
+    create_mosaic(location, BANDS, levels)
+    tile = (160, 50)
+    ds = _output(tile).chunk(dict(x=block, y=block))
+
+    write_mosaic(ds, location, levels).compute(scheduler="threads", num_workers=8)
+
+    # decimated from the same blocks, so sums run in the same order
+    ds = ds.isel(time=0)
+    for factor in levels:
+        for name in ("ndvi_mean", "clear_count"):
+            np.testing.assert_array_equal(
+                _chunk(location, factor, name, tile),
+                decimate(ds[name], factor).values,
+            )
+
+
+def test_write_mosaic_needs_the_store(tmp_path):
+    with pytest.raises(ValueError):
+        write_mosaic(_output((200, 100)), str(tmp_path / "mosaic.zarr"), LEVELS)
+
+
+def test_write_mosaic_in_memory(tmp_path):
+    location = str(tmp_path / "mosaic.zarr")
+    create_mosaic(location, BANDS, LEVELS)
+    ds = _output((200, 100))
+    assert write_mosaic(ds, location, LEVELS) is ds
+
+    np.testing.assert_array_equal(
+        _chunk(location, 32, "ndvi_mean", (200, 100)),
+        decimate(ds.ndvi_mean.isel(time=0), 32).values,
+    )
+
+
+def test_write_mosaic_needs_whole_tiles(tmp_path):
+    ds = _output((160, 50)).isel(x=slice(0, 1600))
+    with pytest.raises(ValueError):
+        write_mosaic(ds, str(tmp_path / "mosaic.zarr"), LEVELS)
+
+
+def test_create_mosaic_from_config(tmp_path):
+    location = str(tmp_path / "{time:%Y-%m}.zarr")
+    config = tmp_path / "anomaly.yaml"
+    config.write_text(
+        yaml.safe_dump(
+            dict(
+                plugin="ndvi_tools.ndvi_anomaly_plugin.NDVIAnomaly",
+                plugin_config=dict(mosaic_location=location, mosaic_levels=[32]),
+            )
+        )
+    )
+
+    runner = CliRunner()
+    assert runner.invoke(main, [str(config)]).exit_code != 0
+    result = runner.invoke(main, [str(config), "--time", "2022-01"])
+    assert result.exit_code == 0, result.output
+
+    mosaic = zarr.open_group(str(tmp_path / "2022-01.zarr"), mode="r")
+    assert mosaic["32/ndvi_mean"].dtype == np.float32
+    assert mosaic["32/clear_count"].dtype == np.int32
+    assert mosaic["32"].attrs["crs"] == str(level_geobox(32).crs)
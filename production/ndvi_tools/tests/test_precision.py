@@ -0,0 +1,71 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from ndvi_tools.cube import monthly_cube
+from ndvi_tools.precision import MAX_ERROR, decode_ndvi, encode_ndvi
+
+
+@pytest.fixture
+def ndvi(make_ndvi):
+    ndvi = make_ndvi(periods=120, shape=(8, 8), freq="6D", missing=0.4, dtype="float64")
+    ndvi[0, 0, :2] = [0, 1]
+    return ndvi
+
+
+@pytest.mark.parametrize("dtype", ["uint16", "float16"])
+def test_encode_decode(ndvi, dtype):
+    encoded = encode_ndvi(ndvi, dtype)
+    assert encoded.dtype == np.dtype(dtype)
+    assert encoded.nbytes * 2 == ndvi.astype(np.float32).nbytes
+
+    decoded = decode_ndvi(encoded)
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded.isnull(), ndvi.isnull())
+    assert float(abs(decoded - ndvi).max()) <= MAX_ERROR[dtype]
+
+
+def test_decode_holds_no_wider_stack():
+    encoded = np.full((50, 200, 200), 65535, dtype=np.uint16)
+    encoded[::2] = 32767
+    encoded = xr.DataArray(encoded, dims=("spec", "y", "x"))
+
+    tracemalloc.start()
+    decoded = decode_ndvi(encoded)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert decoded.dtype == np.float32
+    assert int(decoded.isnull().sum()) == 25 * 200 * 200
+    # only the float32 result, no float64 or boolean stack on top of it
+    assert peak < decoded.nbytes + 5 * 200 * 200
+
+
+def test_float32_is_unchanged(ndvi):
+    ndvi = ndvi.astype(np.float32)
+    assert decode_ndvi(encode_ndvi(ndvi)) is ndvi
+
+
+@pytest.mark.parametrize("dtype", ["uint16", "float16"])
+def test_output_error_is_bounded(ndvi, dtype):
+    def stats(ndvi):
+        cube = monthly_cube(ndvi, 3)
+        mean = cube.ndvi_sum / cube.clear_count
+        std = np.sqrt((cube.ndvi_sumsq / cube.clear_count - mean**2).clip(0))
+        return mean, std
+
+    mean, std = stats(ndvi)
+    mean_q, std_q = stats(decode_ndvi(encode_ndvi(ndvi, dtype)))
+
+    # smoothing and averaging can't amplify the error of one observation,
+    # the std. dev. also moves by at most that error (up to round-off)
+    assert float(abs(mean_q - mean).max()) <= MAX_ERROR[dtype]
+    assert float(abs(std_q - std).max()) <= MAX_ERROR[dtype] * (1 + 1e-6)
+
+    # anomalies scale it by the climatology std. dev.
+    clim_mean, clim_std = 0.5, 0.05
+    anomaly = (mean - clim_mean) / clim_std
+    anomaly_q = (mean_q - clim_mean) / clim_std
+    assert float(abs(anomaly_q - anomaly).max()) <= MAX_ERROR[dtype] / clim_std
@@ -0,0 +1,113 @@
+import copy
+from datetime import datetime
+
+import numpy as np
+import pytest
+import xarray as xr
+from affine import Affine
+from datacube import Datacube
+from datacube.model import Dataset
+from datacube.utils.geometry import GeoBox
+
+from ndvi_tools.preview import (
+    load_with_coarse_transform,
+    preview_filters,
+    preview_geobox,
+)
+
+from .perf.golden import golden_dataset, golden_geobox
+
+
+def test_preview_geobox():
+    geobox = GeoBox(3200, 3200, Affine(30, 0, 0, 0, -30, 96000), "epsg:6933")
+
+    coarse = preview_geobox(geobox, 300)
+    assert coarse.shape == (320, 320)
+    assert coarse.extent == geobox.extent
+    assert preview_geobox(coarse, 300) is coarse
+
+
+def test_preview_filters():
+    filters = [("opening", 5), ("dilation", 20)]
+    assert preview_filters(filters, 30) == filters
+    assert preview_filters(filters, 60) == [("opening", 2), ("dilation", 10)]
+    assert preview_filters(filters, 300) == [("opening", 1), ("dilation", 2)]
+    assert preview_filters(filters, 1000) == [("opening", 1), ("dilation", 1)]
+    assert preview_filters(None, 300) is None
+
+
+def _in_crs(ds: Dataset, crs: str) -> Dataset:
+    doc = copy.deepcopy(ds.metadata_doc)
+    doc["crs"] = doc["grid_spatial"]["projection"]["spatial_reference"] = crs
+    return Dataset(ds.type, doc, uris=ds.uris)
+
+
+@pytest.fixture
+def load_data(monkeypatch):
+    """
+    Stand-in for ``Datacube.load_data`` filling every band with the EPSG
+    code of the geobox it is read on, the calls are recorded.
+    """
+    calls = []
+
+    def load(sources, geobox, measurements, resampling=None, dask_chunks=None):
+        calls.append(
+            dict(
+                sources=sources,
+                geobox=geobox,
+                resampling=resampling,
+                chunks=dask_chunks,
+            )
+        )
+        shape = sources.shape + geobox.shape
+        return xr.Dataset(
+            {
+                name: (
+                    sources.dims + geobox.dims,
+                    np.full(shape, geobox.crs.epsg, m.dtype),
+                )
+                for name, m in measurements.items()
+            },
+            coords={**sources.coords, **geobox.xr_coords(with_crs=True)},
+        )
+
+    monkeypatch.setattr(Datacube, "load_data", staticmethod(load))
+    return calls
+
+
+@pytest.mark.parametrize("chunks", [None, dict(x=3, y=3)])
+def test_load_with_coarse_transform(load_data, chunks):
+    dss = [
+        golden_dataset("ls8_sr", datetime(2021, 8, 1, 10, 58)),
+        _in_crs(golden_dataset("ls8_sr", datetime(2021, 8, 9, 10, 52)), "epsg:32630"),
+        golden_dataset("ls8_sr", datetime(2021, 8, 17, 10, 58)),
+    ]
+    geobox = preview_geobox(golden_geobox(), 300)
+
+    xx = load_with_coarse_transform(
+        dss,
+        ["SR_B4", "QA_PIXEL"],
+        geobox,
+        lambda xx: xx,
+        resampling="bilinear",
+        chunks=chunks,
+    )
+
+    # one read per grid, in the grid's projection at the preview resolution
+    assert len(load_data) == 2
+    assert sorted(c["sources"].shape[0] for c in load_data) == [1, 2]
+    for call in load_data:
+        # the crs of the group's datasets, _split_by_grid labels every group
+        # with the crs of the first one
+        (ds,) = call["sources"].data[0]
+        assert call["geobox"].crs == ds.crs
+        assert call["geobox"].resolution == (-300, 300)
+        assert call["chunks"] == chunks
+        # flag bands are never interpolated
+        assert call["resampling"] == {"*": "bilinear", "QA_PIXEL": "nearest"}
+
+    # reprojected onto the preview geobox and put back together
+    assert xx.geobox == geobox
+    assert xx.SR_B4.shape == (3,) + geobox.shape
+    epsg = [int(xx.SR_B4[i, 0, 0]) for i in range(3)]
+    assert sorted(epsg) == [32629, 32629, 32630]
@@ -1,11 +1,23 @@
 import pytest
 from pathlib import Path
+from types import SimpleNamespace
 
 from odc.dscache import DatasetCache
 
 from datacube.utils.geometry import Geometry
 
-from ndvi_tools.geojson_defined_tasks import filter_tiles, publish_tasks, get_geometry
+from odc.dscache.tools.tiling import parse_gridspec
+
+from ndvi_tools.geojson_defined_tasks import (
+    covers_any_tile,
+    filter_tiles,
+    publish_tasks,
+    get_geometry,
+    product_index,
+    sort_tiles_by_cost,
+    tile_cost,
+)
+from ndvi_tools.subtiles import estimate_read_bytes
 
 import boto3
 import moto
@@ -34,6 +46,89 @@ def test_partition_area(test_db):
     assert len(filtered) == 10
 
 
+def test_covers_any_tile():
+    # 960km tiles at 300m, (-2, 0) contains x170y082
+    gridspec = parse_gridspec("epsg:6933;300;3200")
+    assert covers_any_tile(gridspec, (-2, 0))
+    assert not covers_any_tile(gridspec, (-20, 20))
+
+
+def test_filter_tiles_on_preview_grid():
+    grid = "epsg:6933_300_3200"
+    tiles = [(("2022--P1M", -2, 0), 12), (("2022--P1M", -20, 20), 3)]
+    dataset_cache = SimpleNamespace(
+        grids={grid: parse_gridspec("epsg:6933;300;3200")},
+        tiles=lambda name: tiles if name == grid else [],
+    )
+
+    assert list(filter_tiles(dataset_cache, grid=grid)) == tiles[:1]
+
+
+def test_tile_cost(test_db):
+    dataset_cache = DatasetCache.open_ro(str(test_db))
+    tile = dataset_cache.tiles("africa_30")[0]
+    products = product_index(dataset_cache)
+
+    # costs come from the cache index, the tile's datasets aren't loaded
+    index = SimpleNamespace(
+        grids=dataset_cache.grids, get_group=dataset_cache.get_group
+    )
+    cost = tile_cost(index, tile, index=products)
+    assert cost.region_code == "x170y082"
+    assert cost.datasets == tile[1]
+    assert cost.products == {"s2_l2a": 12}
+    assert cost.read_bytes == estimate_read_bytes({"s2_l2a": 12}, 3200 * 3200)
+    assert cost.resource_class == "small"
+
+
+def test_tile_cost_per_product(test_db):
+    dataset_cache = DatasetCache.open_ro(str(test_db))
+    products = product_index(dataset_cache)
+    costs = [
+        tile_cost(dataset_cache, tile, index=products)
+        for tile in dataset_cache.tiles("africa_30")
+    ]
+
+    for c in costs:
+        assert sum(c.products.values()) == c.datasets
+    # a Sentinel-2 dataset reads more than a Landsat one
+    per_dataset = {
+        c.region_code: c.read_bytes / c.datasets for c in costs if len(c.products) == 1
+    }
+    s2 = [per_dataset[c.region_code] for c in costs if set(c.products) == {"s2_l2a"}]
+    ls = [per_dataset[c.region_code] for c in costs if set(c.products) == {"ls8_sr"}]
+    assert ls and s2
+    assert max(ls) < min(s2)
+
+
+def test_sort_tiles_by_cost(test_db):
+    dataset_cache = DatasetCache.open_ro(str(test_db))
+
+    costs = sort_tiles_by_cost(dataset_cache, filter_tiles(dataset_cache))
+    assert len(costs) == 89
+
+    read_bytes = [c.read_bytes for c in costs]
+    assert read_bytes == sorted(read_bytes, reverse=True)
+
+
+def test_publish_dry_run_report(test_db, capsys):
+    dataset_cache = DatasetCache.open_ro(str(test_db))
+    publish_tasks(dataset_cache, None, "s3://test-files/test.db", dry_run=True, limit=5)
+
+    out = capsys.readouterr().out.splitlines()
+    # header, 5 tiles, totals, resource classes, message count
+    assert len(out) == 9
+    assert out[6].startswith("total")
+    assert "small=5" in out[7]
+    # datasets of each product of a tile
+    assert out[0].split()[-1] == "products"
+    assert all("s2_l2a=" in line or "ls8_sr=" in line for line in out[1:6])
+
+    # the 5 most expensive tiles, not the first 5 in the cache
+    costs = sort_tiles_by_cost(dataset_cache, filter_tiles(dataset_cache))
+    assert [line.split()[0] for line in out[1:6]] == [c.region_code for c in costs[:5]]
+
+
 @moto.mock_sqs
 def test_publish_sns(test_db):
     dataset_cache = DatasetCache.open_ro(str(test_db))
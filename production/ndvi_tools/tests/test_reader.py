@@ -0,0 +1,135 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+from ndvi_tools import reader
+from ndvi_tools.reader import (
+    GDAL_READ_OPTIONS,
+    PooledRasterioDataSource,
+    configure_reader,
+    load_concurrently,
+    read_metrics,
+    reset_read_metrics,
+)
+
+
+class FileDataSource(PooledRasterioDataSource):
+    def get_bandnumber(self, src=None):
+        return 1
+
+
+@pytest.fixture
+def cogs(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"band_{i}.tif"
+        data = rng.integers(0, 10000, (256, 256), dtype="uint16")
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=256,
+            height=256,
+            count=1,
+            dtype="uint16",
+            crs="epsg:32630",
+            transform=Affine(30, 0, 500000, 0, -30, 1000000),
+            nodata=0,
+            tiled=True,
+            blockxsize=64,
+            blockysize=64,
+        ) as dst:
+            dst.write(data, 1)
+        paths.append((str(path), data))
+    return paths
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    for name in GDAL_READ_OPTIONS:
+        monkeypatch.delenv(name, raising=False)
+
+    configure_reader(max_concurrent_reads=2, max_open_files=2)
+    reset_read_metrics()
+    yield
+    reader._state.clear()
+
+
+def test_reads_match_and_handles_are_reused(cogs, pool):
+    path, data = cogs[0]
+    window = ((64, 128), (0, 64))
+
+    for _ in range(3):
+        with FileDataSource(path, nodata=0).open() as src:
+            assert src.nodata == 0
+            np.testing.assert_array_equal(src.read(window), data[64:128, 0:64])
+
+    metrics = read_metrics()
+    assert metrics["opens"] == 1
+    assert metrics["cache_hits"] == 2
+    assert metrics["reads"] == 3
+    assert metrics["bytes"] == 3 * 64 * 64 * 2
+
+
+def test_open_files_are_bounded(cogs, pool):
+    for path, _ in cogs + cogs[:1]:
+        with FileDataSource(path, nodata=0).open() as src:
+            src.read(((0, 64), (0, 64)))
+
+    # the first file was evicted once the third one was opened
+    assert read_metrics()["opens"] == 4
+    assert len(reader._handles()._open) == 2
+
+
+def test_reads_in_flight_are_bounded(cogs, pool):
+    barrier = threading.Barrier(6)
+
+    def read(path, data):
+        barrier.wait()
+        with FileDataSource(path, nodata=0).open() as src:
+            for row in range(0, 256, 64):
+                window = ((row, row + 64), (0, 256))
+                np.testing.assert_array_equal(src.read(window), data[row : row + 64])
+
+    loads = {i: (lambda c=c: read(*c)) for i, c in enumerate(cogs * 2)}
+    load_concurrently(loads)
+
+    metrics = read_metrics()
+    assert metrics["reads"] == 6 * 4
+    assert 1 <= metrics["max_in_flight"] <= 2
+    assert metrics["in_flight"] == 0
+
+
+def test_gdal_options_are_scoped(cogs, pool):
+    path, _ = cogs[0]
+    with FileDataSource(path, nodata=0).open():
+        env = rasterio.env.getenv()
+        for name, value in GDAL_READ_OPTIONS.items():
+            assert env[name] == value
+
+    assert not any(name in os.environ for name in GDAL_READ_OPTIONS)
+
+
+def test_no_slot_is_held_waiting_for_a_file(cogs, pool):
+    configure_reader(max_concurrent_reads=1)
+    window = ((0, 64), (0, 64))
+
+    def read(path):
+        with FileDataSource(path, nodata=0).open() as src:
+            src.read(window)
+
+    with FileDataSource(cogs[0][0], nodata=0).open() as busy:
+        # another read of the busy file waits for it, outside the pool
+        with busy._lock:
+            waiting = threading.Thread(target=busy.read, args=(window,))
+            waiting.start()
+            other = threading.Thread(target=read, args=(cogs[1][0],))
+            other.start()
+            other.join(timeout=10)
+            assert not other.is_alive()
+        waiting.join()
@@ -0,0 +1,85 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+import xarray as xr
+from datacube.utils.geometry import assign_crs
+
+from ndvi_tools.ndvi_climatology_plugin import NDVIClimatology
+from ndvi_tools.precision import decode_ndvi, encode_ndvi
+from ndvi_tools.smoothing import smoothed_sums
+from ndvi_tools.validity import remask
+
+
+def _expected(ndvi, rolling_window, key, tail=None):
+    if tail is not None:
+        # smoothed as encoded like the stack
+        tail = decode_ndvi(encode_ndvi(tail, str(ndvi.dtype)))
+    ndvi = decode_ndvi(ndvi).astype(np.float64)
+    series = ndvi if tail is None else xr.concat([tail, ndvi], dim="spec")
+    smooth = series.rolling(spec=rolling_window, min_periods=1).mean()
+    smooth = remask(smooth, series).isel(spec=slice(len(series) - len(ndvi), None))
+    return xr.Dataset(
+        dict(
+            clear_count=smooth.notnull().groupby(key).sum("spec").astype(np.int16),
+            ndvi_sum=smooth.groupby(key).sum("spec"),
+            ndvi_sumsq=(smooth**2).groupby(key).sum("spec"),
+        )
+    )
+
+
+@pytest.mark.parametrize("dtype", ["float32", "uint16"])
+@pytest.mark.parametrize("with_tail", [False, True])
+def test_smoothed_sums(make_ndvi, dtype, with_tail):
+    ndvi = make_ndvi(periods=40, missing=0.4)
+    tail = None
+    if with_tail:
+        tail, ndvi = ndvi.isel(spec=slice(0, 2)), ndvi.isel(spec=slice(2, None))
+    ndvi = encode_ndvi(ndvi, dtype)
+    key = ndvi.spec["time.month"]
+    expected = _expected(ndvi, 3, key, tail)
+
+    sums = smoothed_sums(ndvi, 3, key=key, tail=tail)
+    lazy = smoothed_sums(ndvi.chunk(dict(spec=7, y=4, x=3)), 3, key=key, tail=tail)
+    lazy = lazy.compute()
+
+    for name in ("clear_count", "ndvi_sum", "ndvi_sumsq"):
+        assert sums[name].dtype == lazy[name].dtype == expected[name].dtype
+        np.testing.assert_allclose(sums[name], expected[name], rtol=1e-6)
+    # same smoothing on both engines, summed in float64
+    xr.testing.assert_equal(sums.clear_count, lazy.clear_count)
+    xr.testing.assert_equal(
+        (sums.ndvi_sum / sums.clear_count).astype(np.float32),
+        (lazy.ndvi_sum / lazy.clear_count).astype(np.float32),
+    )
+
+
+def test_smoothed_sums_without_key(make_ndvi):
+    ndvi = make_ndvi(periods=10)
+    sums = smoothed_sums(ndvi, 3)
+
+    assert sums.clear_count.dims == ("y", "x")
+    np.testing.assert_array_equal(sums.clear_count, ndvi.notnull().sum("spec"))
+
+
+def test_reduce_peak_does_not_grow_with_the_series(make_ndvi, done):
+    plugin = NDVIClimatology(rolling_window=3)
+    peaks = []
+    for periods in (240, 960):
+        ndvi = encode_ndvi(make_ndvi(periods, (100, 100), "5D", 0.5), "uint16")
+        xx = assign_crs(ndvi, "epsg:6933").to_dataset(name="ndvi")
+        wofs = xr.DataArray(
+            np.ones((100, 100), dtype=bool),
+            dims=("y", "x"),
+            coords=dict(y=xx.y, x=xx.x),
+        )
+
+        tracemalloc.start()
+        plugin._reduce(xx, wofs=done(wofs))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+
+    # neither a decoded nor a smoothed stack, the encoded one alone is larger
+    assert peaks[1] < 1.1 * peaks[0]
+    assert peaks[1] < ndvi.nbytes
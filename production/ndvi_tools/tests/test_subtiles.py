@@ -0,0 +1,110 @@
+from collections import Counter
+
+import dask.array as da
+import numpy as np
+import pytest
+import xarray as xr
+
+from ndvi_tools.subtiles import (
+    _split_axis,
+    estimate_read_bytes,
+    reduce_by_subtile,
+    subtile_shape,
+)
+
+
+def test_subtile_shape():
+    tile = (3200, 3200)
+    read_bytes = estimate_read_bytes({"ls8_sr": 10, "s2_l2a": 20}, 3200 * 3200)
+    assert subtile_shape(read_bytes) == (1, 1)
+    assert subtile_shape(read_bytes, read_bytes, tile, (800, 800)) == (1, 1)
+
+    # in memory windows only hold themselves
+    assert subtile_shape(read_bytes, read_bytes / 4, tile) == (2, 2)
+    assert subtile_shape(read_bytes, read_bytes / 5, tile) == (1, 5)
+
+    # windows of 2x2 chunks read 3x3 chunks with their halo, single chunk
+    # windows read as much in the middle of the tile
+    assert subtile_shape(read_bytes, read_bytes * 0.6, tile, (800, 800)) == (2, 2)
+    assert subtile_shape(read_bytes, read_bytes / 4, tile, (800, 800)) == (2, 2)
+    assert subtile_shape(read_bytes, read_bytes / 4, tile, (400, 400)) == (4, 4)
+
+    # with 2 chunks per side any window reads the whole tile
+    assert subtile_shape(read_bytes, read_bytes / 4, tile, (1600, 1600)) == (1, 1)
+
+
+@pytest.mark.parametrize("n", range(1, 9))
+def test_subtile_shape_is_what_runs(n):
+    # the reported split is the one reduce_by_subtile makes
+    tile, chunks = (3200, 3200), (400, 400)
+    shape = subtile_shape(n * 100, 100, tile, chunks)
+    assert len(_split_axis(tile[0], shape[0], chunks[0])) == shape[0]
+    assert len(_split_axis(tile[1], shape[1], chunks[1])) == shape[1]
+
+
+@pytest.mark.parametrize("shape", [(2, 2), (3, 2), (4, 3)])
+def test_reduce_by_subtile_matches_full_tile(shape):
+    # spatial filter with a halo, like mask_cleanup, ahead of the split
+    data = da.random.random((5, 40, 30), chunks=(1, 10, 10))
+    data = data.map_overlap(
+        lambda b: np.maximum(b, np.roll(b, 2, axis=-1)),
+        depth=(0, 2, 2),
+        boundary="none",
+    )
+    xx = xr.Dataset(
+        {"ndvi": (("spec", "y", "x"), data)},
+        coords={"y": np.arange(40), "x": np.arange(30)},
+    )
+
+    def reduce(xx):
+        return xr.Dataset(
+            {
+                "ndvi_mean": xx.ndvi.mean("spec"),
+                "clear_count": xx.ndvi.count("spec").astype("int16"),
+            }
+        )
+
+    expected = reduce(xx).compute()
+    stitched = reduce_by_subtile(reduce, xx, shape, chunks={"y": 10, "x": 10})
+    xr.testing.assert_identical(stitched, expected)
+
+
+def test_reduce_by_subtile_is_lazy_and_reads_the_halo():
+    reads = Counter()
+
+    def read(block_info=None):
+        reads[block_info[None]["chunk-location"]] += 1
+        return np.ones(block_info[None]["chunk-shape"])
+
+    data = da.map_blocks(read, chunks=((10,) * 4, (10,) * 3), dtype=float)
+    data = data.map_overlap(lambda b: b, depth=1, boundary="none")
+    xx = xr.Dataset({"ndvi": (("y", "x"), data)})
+
+    stitched = reduce_by_subtile(lambda xx: xx, xx, (2, 3), chunks={"y": 10, "x": 10})
+    assert not reads
+    assert (stitched.ndvi.compute() == 1).all()
+
+    # windows of 2x1 chunks, every chunk is read by the windows it is in or
+    # borders, including diagonally
+    windows = [(y, x) for y in (range(0, 2), range(2, 4)) for x in range(3)]
+    expected = {
+        (i, j): sum(
+            min(abs(i - y) for y in ys) <= 1 and abs(j - x) <= 1 for ys, x in windows
+        )
+        for i in range(4)
+        for j in range(3)
+    }
+    assert reads == expected
+
+
+def test_reduce_by_subtile_on_distributed():
+    distributed = pytest.importorskip("distributed")
+    data = da.random.random((3, 40, 30), chunks=(1, 10, 10))
+    xx = xr.Dataset({"ndvi": (("spec", "y", "x"), data)})
+
+    def reduce(xx):
+        return xr.Dataset({"ndvi_mean": xx.ndvi.mean("spec")})
+
+    with distributed.Client(processes=False, n_workers=1, threads_per_worker=2):
+        stitched = reduce_by_subtile(reduce, xx, (2, 2), chunks={"y": 10, "x": 10})
+        xr.testing.assert_allclose(stitched.compute(), reduce(xx).compute())
@@ -0,0 +1,69 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+import xarray as xr
+from datacube.utils.geometry import assign_crs
+
+from ndvi_tools.ndvi_climatology_plugin import NDVIClimatology
+from ndvi_tools.validity import clear_count, remask
+
+
+@pytest.fixture
+def ndvi(make_ndvi):
+    return make_ndvi(periods=40, shape=(12, 10), missing=0.4)
+
+
+@pytest.mark.parametrize("chunks", [None, dict(spec=7, y=5, x=4)])
+def test_clear_count(ndvi, chunks):
+    xx = ndvi if chunks is None else ndvi.chunk(chunks)
+    count = clear_count(xx)
+    assert count.dtype == np.int16
+    assert count.dims == ("y", "x")
+    np.testing.assert_array_equal(count.values, ndvi.notnull().sum("spec").values)
+
+
+@pytest.mark.parametrize("chunks", [None, dict(spec=7, y=5, x=4)])
+def test_remask(ndvi, chunks):
+    xx = ndvi if chunks is None else ndvi.chunk(chunks)
+    smooth = xx.rolling(spec=3, min_periods=1).mean()
+    expected = smooth.where(ndvi.notnull()).compute()
+
+    xr.testing.assert_identical(remask(smooth, xx).compute(), expected)
+    if chunks is not None:
+        # blocks of the smoothed series are not modified in place
+        assert smooth.compute().notnull().sum() > expected.notnull().sum()
+
+
+def test_clear_count_has_no_time_stack():
+    ndvi = np.full((50, 200, 200), np.nan, dtype=np.float32)
+    ndvi[::2] = 0.5
+    ndvi = xr.DataArray(ndvi, dims=("spec", "y", "x"))
+
+    tracemalloc.start()
+    count = clear_count(ndvi)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert (count == 25).all()
+    # a boolean stack alone would take 50 * 200 * 200 bytes
+    assert peak < 5 * 200 * 200
+
+
+def test_climatology_counts_and_remasking(ndvi, done):
+    wofs = xr.DataArray(
+        np.ones((12, 10), dtype=bool), dims=("y", "x"), coords=dict(y=ndvi.y, x=ndvi.x)
+    )
+    ndvi = assign_crs(ndvi, "epsg:6933")
+    plugin = NDVIClimatology(rolling_window=3)
+    clim = plugin._reduce(ndvi.to_dataset(name="ndvi"), wofs=done(wofs))
+
+    jan = ndvi.spec["time.month"] == 1
+    # float64 like the smoothing kernels accumulate
+    smooth = ndvi.astype(np.float64).rolling(spec=3, min_periods=1).mean()
+    smooth = smooth.where(ndvi.notnull())
+    np.testing.assert_array_equal(clim.count_jan, ndvi[jan].notnull().sum("spec"))
+    np.testing.assert_allclose(
+        clim.mean_jan, smooth[jan].mean("spec").astype(np.float32)
+    )
+    np.testing.assert_allclose(clim.stddev_jan, smooth[jan].std("spec"), rtol=1e-6)